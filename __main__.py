@@ -4,13 +4,13 @@ import os
 import asyncio
 import sys
 import json
-from . import git, pijul, www, server
-from .sync import sync
+from . import git, pijul, www, server, scheduler, sync, command
 
-config = None
+# Mirror pairs served by this process
+configs = []
 
 async def main():
-    global config
+    global configs
 
     # Try to read config
     setup_config = "--setup-config" in sys.argv[1:]
@@ -20,6 +20,99 @@ async def main():
         config_path = sys.argv[1]
     except IndexError:
         config_path = "~/.config/pgproxy.conf"
+
+    print(chalk.yellow(chalk.bold("Welcome to PijulGit proxy!")))
+
+    if os.path.isdir(os.path.expanduser(config_path)) and not setup_config:
+        configs, options = readConfigDir(config_path)
+    else:
+        config = readConfig(config_path, setup_config)
+        configs, options = [config], config
+
+    command.timeouts.update(options.get("timeouts", {}))
+    scheduler.setMaxSyncs(options.get("max_syncs", scheduler.MAX_SYNCS))
+    sync.setStateDir(options.get("state_dir", sync.STATE_DIR))
+    if "object_pool" in options:
+        await sync.setObjectPool(options["object_pool"])
+
+    # Two processes syncing the same working copy would break it
+    for config in configs:
+        for url in (config["git"]["url"], config["pijul"]["url"]):
+            if not sync.lockWorkingCopy(url):
+                print(chalk.red(f"{url} is being mirrored by another process using {sync.state_dir}"))
+                raise SystemExit(1)
+
+    await www.init()
+
+    # Authorize, once per user
+    for config in configs:
+        git_host = git.getUrlHost(config["git"]["url"])
+        if "login" in config["git"] and git_host in git.hook_supported_hosts and config["git"]["login"] not in git.access_tokens:
+            print(f"Authorizing on {git_host}...")
+            r = await git.authorize(git_host, config["git"]["login"], config["git"]["password"])
+            if r == "ok":
+                print(chalk.green("Authorized successfully!"))
+            else:
+                print(chalk.red(r))
+                raise SystemExit(1)
+
+        pijul_host = pijul.getUrlHost(config["pijul"]["url"])
+        if "login" in config["pijul"] and pijul_host in pijul.hook_supported_hosts and config["pijul"]["login"] != pijul.logged_in_as:
+            print(f"Authorizing on {pijul_host}...")
+            r = await pijul.authorize(pijul_host, config["pijul"]["login"], config["pijul"]["password"])
+            if r == "ok":
+                print(chalk.green("Authorized successfully!"))
+            else:
+                print(chalk.red(r))
+                raise SystemExit(1)
+
+    # Start pooling threads
+    pools = []
+    for config in configs:
+        if "login" not in config["git"]:
+            pools.append(asyncio.create_task(gitPool(config)))
+            print(chalk.green(f"Started Git pooling thread for {config['git']['url']}"))
+        if "login" not in config["pijul"]:
+            pools.append(asyncio.create_task(pijulPool(config)))
+            print(chalk.green(f"Started Pijul pooling thread for {config['pijul']['url']}"))
+
+    print("Initial sync...")
+    # Failures are reported by the scheduler; the other pairs keep going
+    await asyncio.gather(*(scheduler.trigger(config) for config in configs), return_exceptions=True)
+
+    # Start server
+    await server.start(onBind, configs)
+
+    await www.destroy()
+
+
+def readConfigDir(path):
+    # Every *.conf file in the directory describes a mirror pair, except
+    # daemon.conf, which holds options of the whole process
+    configs = []
+    options = {}
+    for name in sorted(os.listdir(os.path.expanduser(path))):
+        if not name.endswith(".conf"):
+            continue
+        try:
+            with open(os.path.join(os.path.expanduser(path), name)) as f:
+                config = json.loads(f.read())
+        except (IOError, ValueError) as e:
+            print(chalk.red(f"Unable to read config file from {os.path.join(path, name)}:"))
+            print(chalk.red(str(e)))
+            raise SystemExit(1)
+        if name == "daemon.conf":
+            options = config
+        else:
+            configs.append(config)
+    if configs == []:
+        print(chalk.red(f"No mirror configs found in {path}."))
+        raise SystemExit(1)
+    print(chalk.green(f"Found {len(configs)} mirror configs in {path}, using them"))
+    return configs, options
+
+
+def readConfig(config_path, setup_config):
     if setup_config:
         config = None
     else:
@@ -34,9 +127,6 @@ async def main():
                 print(chalk.red(str(e)))
                 raise SystemExit(1)
 
-
-    print(chalk.yellow(chalk.bold("Welcome to PijulGit proxy!")))
-
     # Set up configuration file if required
     if config is None:
         if setup_config:
@@ -99,62 +189,58 @@ async def main():
             raise SystemExit(0)
     else:
         print(chalk.green(f"Found existing config at {config_path}, using it"))
-
-    await www.init()
-
-    # Authorize
-    git_host = git.getUrlHost(config["git"]["url"])
-    if "login" in config["git"] and git_host in git.hook_supported_hosts:
-        print(f"Authorizing on {git_host}...")
-        r = await git.authorize(git_host, config["git"]["login"], config["git"]["password"])
-        if r == "ok":
-            print(chalk.green("Authorized successfully!"))
-        else:
-            print(chalk.red(r))
-            raise SystemExit(1)
-
-    pijul_host = pijul.getUrlHost(config["pijul"]["url"])
-    if "login" in config["pijul"] and pijul_host in pijul.hook_supported_hosts:
-        print(f"Authorizing on {pijul_host}...")
-        r = await pijul.authorize(pijul_host, config["pijul"]["login"], config["pijul"]["password"])
-        if r == "ok":
-            print(chalk.green("Authorized successfully!"))
-        else:
-            print(chalk.red(r))
-            raise SystemExit(1)
-
-    # Start pooling threads
-    if "login" not in config["git"]:
-        await asyncio.create_task(gitPool())        
-        print(chalk.green("Started Git pooling thread"))
-    if "login" not in config["pijul"]:
-        await asyncio.create_task(pijulPool())        
-        print(chalk.green("Started Pijul pooling thread"))
-
-    print("Initial sync...")
-    await sync(config)
-
-    # Start server
-    await server.start(onBind, config)
-
-    await www.destroy()
+    return config
 
 
 async def onBind(host):
-    if "login" in config["git"]:
-        await git.setHooks(config["git"]["url"], host)
-    if "login" in config["pijul"]:
-        await pijul.setHooks(config["pijul"]["url"], host)
-
-async def gitPool():
+    for config in configs:
+        if "login" in config["git"]:
+            await git.setHooks(config["git"]["url"], host, config["git"]["login"])
+        if "login" in config["pijul"]:
+            if config["pijul"]["login"] != pijul.logged_in_as:
+                host_name = pijul.getUrlHost(config["pijul"]["url"])
+                await pijul.authorize(host_name, config["pijul"]["login"], config["pijul"]["password"])
+            await pijul.setHooks(config["pijul"]["url"], host)
+
+async def pool(config, check):
+    # Only sync when check() reports a different remote state. While nothing
+    # changes, or checks and syncs fail, poll less and less often.
+    interval = 2
+    state = None
+    checked = False
     while True:
-        await asyncio.sleep(2)
-        await sync(config)
-
-async def pijulPool():
-    while True:
-        await asyncio.sleep(2)
-        await sync(config)
-
-
-asyncio.run(main())
\ No newline at end of file
+        try:
+            new_state = await check()
+            if not checked:
+                state = new_state
+                checked = True
+            elif new_state is None or new_state == state:
+                interval = min(interval * 2, config.get("pool_interval_max", 60))
+            else:
+                # If the sync fails, it's retried on the next check
+                await scheduler.trigger(config)
+                # The sync pushes to the remote too, so take the state it
+                # left behind, or the next check would trigger a sync again
+                synced_state = await check()
+                state = new_state if synced_state is None else synced_state
+                interval = 2
+        except Exception as e:
+            # Syncs are reported by the scheduler, but the checks aren't
+            print(chalk.red(f"Pooling for {config['git']['url']} failed: {e}"))
+            interval = min(interval * 2, config.get("pool_interval_max", 60))
+        await asyncio.sleep(interval)
+
+async def gitPool(config):
+    await pool(config, lambda: sync.remoteGitState(config["git"]["url"]))
+
+async def pijulPool(config):
+    async def check():
+        # Pulling changes the working copy, so don't do that during a sync
+        async with scheduler.lock(config):
+            return await sync.remotePijulState(config["pijul"]["url"])
+    await pool(config, check)
+
+
+# Merges run on a process pool, whose workers may import this module again
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import os
+import re
+import shlex
+import signal
+import time
+import chalk
+
+# Commands are executed directly, without a shell, each in its own process
+# group, so that a command that hangs can be killed together with whatever it
+# started (e.g. ssh).
+
+# Seconds a command may take, per command class. Overridden by the "timeouts"
+# config key.
+timeouts = {
+    "network": 300,
+    "local": 1800
+}
+
+NETWORK_COMMANDS = {
+    ("git", "clone"),
+    ("git", "fetch"),
+    ("git", "push"),
+    ("git", "ls-remote"),
+    ("pijul", "clone"),
+    ("pijul", "pull"),
+    ("pijul", "push")
+}
+
+# Bytes of stderr kept per command
+STDERR_TAIL = 2000
+
+# Recently finished commands, oldest first
+history = collections.deque(maxlen=200)
+
+
+def redact(text):
+    # Drop "login:password@" from URLs, as the history is served publicly
+    return re.sub(r"([A-Za-z][A-Za-z0-9+.\-]*://)[^/@\s]*@", r"\1", text)
+
+
+def classify(argv):
+    return "network" if tuple(argv[:2]) in NETWORK_COMMANDS else "local"
+
+
+async def start(argv, cwd, input):
+    return await asyncio.create_subprocess_exec(
+        *argv,
+        cwd=cwd,
+        stdin=None if input is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+
+def kill(proc):
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+async def reap(proc):
+    # Kill the command and wait for it. asyncio only reports the exit once the
+    # pipes are closed, so drop what's left of the output.
+    kill(proc)
+    while await proc.stdout.read(1 << 16) != b"":
+        pass
+    await proc.wait()
+
+async def feed(proc, input):
+    try:
+        proc.stdin.write(input.encode())
+        await proc.stdin.drain()
+        proc.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        # The command exited without reading everything
+        pass
+
+async def readAll(proc):
+    stdout = await proc.stdout.read()
+    await proc.wait()
+    return stdout
+
+async def readTail(pipe):
+    tail = b""
+    while True:
+        chunk = await pipe.read(1 << 16)
+        if chunk == b"":
+            return tail
+        tail = (tail + chunk)[-STDERR_TAIL:]
+
+def record(argv, cwd, kind, started, returncode, timed_out, stderr):
+    entry = {
+        "command": redact(shlex.join(argv)),
+        "cwd": cwd,
+        "class": kind,
+        "started": started,
+        "duration": time.time() - started,
+        "returncode": returncode,
+        "timed_out": timed_out,
+        "stderr": redact(stderr.decode(errors="replace"))
+    }
+    history.append(entry)
+    if timed_out:
+        print(chalk.red(f"  Command timed out after {entry['duration']:.0f}s: {entry['command']}"))
+
+
+async def run(argv, cwd=None, check=False, input=None, timeout=None):
+    # Returns stdout of the command. If check is set, returns None if the
+    # command failed or timed out; otherwise a timeout raises TimeoutError.
+    kind = classify(argv)
+    if timeout is None:
+        timeout = timeouts[kind]
+    started = time.time()
+    proc = await start(argv, cwd, input)
+    stderr = asyncio.ensure_future(readTail(proc.stderr))
+    feeder = None if input is None else asyncio.ensure_future(feed(proc, input))
+    try:
+        stdout = await asyncio.wait_for(readAll(proc), timeout)
+    except asyncio.TimeoutError:
+        await reap(proc)
+        record(argv, cwd, kind, started, proc.returncode, True, await stderr)
+        if check:
+            return None
+        raise
+    except asyncio.CancelledError:
+        kill(proc)
+        stderr.cancel()
+        raise
+    finally:
+        if feeder is not None:
+            feeder.cancel()
+    record(argv, cwd, kind, started, proc.returncode, False, await stderr)
+    if check and proc.returncode != 0:
+        return None
+    return stdout.decode()
+
+async def stream(argv, cwd=None, input=None, sep="\n", timeout=None):
+    # Like run(), but yields the output record by record as it's produced. The
+    # output is only read as fast as it's consumed, so the command is paused
+    # rather than buffered. Close the generator to stop early; the command is
+    # killed then. The timeout covers the whole stream and raises
+    # TimeoutError, so that truncated output is never mistaken for a complete
+    # one.
+    kind = classify(argv)
+    if timeout is None:
+        timeout = timeouts[kind]
+    started = time.time()
+    deadline = time.monotonic() + timeout
+    proc = await start(argv, cwd, input)
+    stderr = asyncio.ensure_future(readTail(proc.stderr))
+    feeder = None if input is None else asyncio.ensure_future(feed(proc, input))
+    sep = sep.encode()
+    finished = False
+    timed_out = False
+    try:
+        buf = b""
+        while True:
+            try:
+                chunk = await asyncio.wait_for(proc.stdout.read(1 << 16), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                timed_out = True
+                raise
+            if chunk == b"":
+                finished = True
+                break
+            *records, buf = (buf + chunk).split(sep)
+            for r in records:
+                yield r.decode()
+        if buf != b"":
+            yield buf.decode()
+    finally:
+        if feeder is not None:
+            feeder.cancel()
+        if not finished:
+            await reap(proc)
+        await proc.wait()
+        record(argv, cwd, kind, started, proc.returncode, timed_out, await stderr)
+
+async def spawn(argv, cwd=None, timeout=None):
+    # Start a command that's talked to through its stdin and stdout while it
+    # runs, e.g. `git cat-file --batch`. Such a command lives as long as it's
+    # needed, so the timeout only applies to a single request: call touch()
+    # before it and rest() once it's answered. Returns a handle for finish().
+    kind = classify(argv)
+    handle = {
+        "proc": await start(argv, cwd, ""),
+        "argv": argv,
+        "cwd": cwd,
+        "class": kind,
+        "started": time.time(),
+        "timeout": timeouts[kind] if timeout is None else timeout,
+        "timer": None,
+        "timed_out": False
+    }
+    handle["stderr"] = asyncio.ensure_future(readTail(handle["proc"].stderr))
+    return handle
+
+def touch(handle):
+    def expire():
+        handle["timed_out"] = True
+        kill(handle["proc"])
+    rest(handle)
+    handle["timer"] = asyncio.get_running_loop().call_later(handle["timeout"], expire)
+
+def rest(handle):
+    if handle["timer"] is not None:
+        handle["timer"].cancel()
+        handle["timer"] = None
+
+def failure(handle):
+    # Returns the exception to raise when the command stopped answering
+    command = redact(shlex.join(handle["argv"]))
+    if handle["timed_out"]:
+        return asyncio.TimeoutError(f"{command} timed out")
+    return RuntimeError(f"{command} exited unexpectedly")
+
+async def finish(handle):
+    # Close stdin of the command and wait for it to exit. Returns the exit
+    # code.
+    proc = handle["proc"]
+    touch(handle)
+    proc.stdin.close()
+    # asyncio only reports the exit once the output is drained
+    while await proc.stdout.read(1 << 16) != b"":
+        pass
+    await proc.wait()
+    rest(handle)
+    record(handle["argv"], handle["cwd"], handle["class"], handle["started"], proc.returncode, handle["timed_out"], await handle["stderr"])
+    return proc.returncode
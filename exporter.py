@@ -0,0 +1,220 @@
+from . import command
+from .command import run, stream
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+
+# Exported commits are written to a single `git fast-import` stream per sync,
+# so neither the Git worktree nor the index are ever touched. An export is a
+# dict holding the fast-import process and the per-branch state.
+
+# Every that many commits on a branch, the whole working copy is compared to
+# the exported tree instead of just the paths the patch touched
+RECONCILE_EVERY = 100
+
+# Working copy -> {path: (stat key, (mode, blob))}, so that only files whose
+# stat changed are hashed again
+stat_cache = {}
+
+
+async def start(git):
+    marks = f"{os.path.abspath(git)}/.git/pijul-export-marks"
+    return {
+        "command": await command.spawn(["git", "fast-import", "--quiet", f"--export-marks={marks}"], cwd=git),
+        "git": git,
+        "marks": marks,
+        "last_mark": 0,
+        "commits": [],
+        "branches": {},
+        # Branches are exported concurrently, but commits have to be written
+        # to the stream one by one
+        "lock": asyncio.Lock()
+    }
+
+async def finish(export):
+    # Returns {mark: commit}, or None if fast-import failed
+    if await command.finish(export["command"]) != 0:
+        return None
+    marks = {}
+    with open(export["marks"]) as f:
+        for line in f:
+            mark, commit = line.split()
+            marks[int(mark[1:])] = commit
+    os.unlink(export["marks"])
+    return marks
+
+
+async def readTree(git, branch):
+    # Returns {path: (mode, blob)} of the branch tip, or None if there's no
+    # such branch
+    if await run(["git", "rev-parse", "--verify", "-q", f"refs/heads/{branch}^{{commit}}"], cwd=git, check=True) is None:
+        return None
+    tree = {}
+    async for entry in stream(["git", "ls-tree", "-r", "-z", "--full-tree", f"refs/heads/{branch}"], cwd=git, sep="\0"):
+        if entry == "":
+            continue
+        # "<mode> <type> <blob>\t<path>"
+        meta, path = entry.split("\t", 1)
+        mode, kind, blob = meta.split(" ")
+        if kind == "blob":  # submodules can't come from Pijul
+            tree[path] = (mode, blob)
+    return tree
+
+
+def hashBlob(path, st):
+    # Same as `git hash-object`, without loading the whole file
+    h = hashlib.sha1(f"blob {st.st_size}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def readEntry(root, path):
+    # Returns (mode, blob) of a file in the working copy
+    full_path = os.path.join(root, path)
+    st = os.lstat(full_path)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode)
+    cache = stat_cache.setdefault(root, {})
+    if path in cache and cache[path][0] == key:
+        return cache[path][1]
+    if os.path.islink(full_path):
+        target = os.readlink(full_path).encode()
+        entry = ("120000", hashlib.sha1(f"blob {len(target)}\0".encode() + target).hexdigest())
+    else:
+        mode = "100755" if st.st_mode & 0o111 else "100644"
+        entry = (mode, hashBlob(full_path, st))
+    cache[path] = (key, entry)
+    return entry
+
+def scanTree(root, subdir=""):
+    # Returns {path: (mode, blob)} of the working copy or its subdirectory
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, subdir)):
+        dirnames[:] = [name for name in dirnames if name not in (".git", ".pijul")]
+        for name in filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]:
+            path = os.path.relpath(os.path.join(dirpath, name), root)
+            tree[path] = readEntry(root, path)
+    return tree
+
+def updateTree(tree, root, paths):
+    # Re-read the given paths of the working copy into tree in place. Returns
+    # {path: old entry} of all paths that may have changed.
+    old = {}
+    def forget(path):
+        if path not in old:
+            old[path] = tree.get(path)
+        tree.pop(path, None)
+
+    for path in paths:
+        path = os.path.normpath(path)
+        full_path = os.path.join(root, path)
+        is_file = os.path.islink(full_path) or os.path.isfile(full_path)
+        if path not in tree and not is_file:
+            # A directory, now or before
+            prefix = path + "/"
+            for old_path in [old_path for old_path in tree if old_path.startswith(prefix)]:
+                forget(old_path)
+        forget(path)
+        if is_file:
+            tree[path] = readEntry(root, path)
+        elif os.path.isdir(full_path):
+            subtree = scanTree(root, path)
+            for sub_path in subtree:
+                forget(sub_path)
+            tree.update(subtree)
+    return old
+
+
+def quotePath(path):
+    if path.startswith("\"") or any(c in path for c in "\"\\\n"):
+        return "\"" + path.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") + "\""
+    return path
+
+def formatPerson(author, timestamp):
+    # fast-import wants "Name <email> <seconds> <offset>"
+    match = re.fullmatch(r"(.*?)\s*<(.*)>", author.strip())
+    if match:
+        name, email = match.groups()
+    else:
+        name, email = author.strip(), ""
+    try:
+        date = datetime.datetime.fromisoformat(timestamp.replace(" UTC", ""))
+    except ValueError:
+        date = datetime.datetime.now(datetime.timezone.utc)
+    if date.tzinfo is None:
+        # Pijul timestamps are in UTC
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    offset = int(date.utcoffset().total_seconds()) // 60
+    sign = "-" if offset < 0 else "+"
+    offset = abs(offset)
+    return f"{name} <{email}> {int(date.timestamp())} {sign}{offset // 60:02}{offset % 60:02}"
+
+
+async def write(export, data):
+    handle = export["command"]
+    command.touch(handle)
+    try:
+        handle["proc"].stdin.write(data)
+        await handle["proc"].stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        raise command.failure(handle)
+    command.rest(handle)
+
+async def commit(export, branch, root, author, timestamp, message, paths=None):
+    # Commit the working copy at root on top of the branch. If paths is
+    # passed, only they are looked at. Returns the mark of the commit and the
+    # number of changed paths.
+    async with export["lock"]:
+        return await writeCommit(export, branch, root, author, timestamp, message, paths)
+
+async def writeCommit(export, branch, root, author, timestamp, message, paths):
+    state = export["branches"].get(branch)
+    if state is None:
+        tree = await readTree(export["git"], branch)
+        state = {
+            "tree": tree or {},
+            "from": None if tree is None else f"refs/heads/{branch}^0",
+            "partial_commits": 0
+        }
+        export["branches"][branch] = state
+
+    export["last_mark"] += 1
+    mark = export["last_mark"]
+    person = formatPerson(author, timestamp)
+    message = message.encode()
+    header = f"commit refs/heads/{branch}\nmark :{mark}\nauthor {person}\ncommitter {person}\ndata {len(message)}\n".encode()
+    await write(export, header + message + b"\n")
+    if state["from"] is not None:
+        await write(export, f"from {state['from']}\n".encode())
+        state["from"] = None
+
+    # Only emit paths that differ from the previous commit
+    if paths is None or state["partial_commits"] >= RECONCILE_EVERY:
+        tree = scanTree(root)
+        old = {path: state["tree"].get(path) for path in set(tree) | set(state["tree"])}
+        state["tree"] = tree
+        state["partial_commits"] = 0
+    else:
+        tree = state["tree"]
+        old = updateTree(tree, root, paths)
+        state["partial_commits"] += 1
+    changed = 0
+    for path in sorted(old):
+        entry = tree.get(path)
+        if old[path] == entry:
+            continue
+        changed += 1
+        if entry is None:
+            await write(export, f"D {quotePath(path)}\n".encode())
+            continue
+        full_path = os.path.join(root, path)
+        if entry[0] == "120000":
+            data = os.readlink(full_path).encode()
+        else:
+            with open(full_path, "rb") as f:
+                data = f.read()
+        await write(export, f"M {entry[0]} inline {quotePath(path)}\ndata {len(data)}\n".encode() + data + b"\n")
+    await write(export, b"\n")
+    return mark, changed
@@ -36,10 +36,10 @@ def getUrlRepository(url):
         raise NotImplementedError()
 
 
-access_token = None
+# Login -> access token, as mirrored projects may belong to different users
+access_tokens = {}
 
 async def authorize(host, login, password):
-    global access_token
     if host == "gitlab.com":
         res = await post("https://gitlab.com/oauth/token", {
             "grant_type": "password",
@@ -50,15 +50,16 @@ async def authorize(host, login, password):
         if "error" in res:
             return res["error"]
         else:
-            access_token = res["access_token"]
+            access_tokens[login] = res["access_token"]
             return "ok"
     else:
         return "Unknown host"
 
 
-async def setHooks(url, host):
+async def setHooks(url, host, login):
     project = getUrlRepository(url)
     print(f"Setting hooks for {project} at GitLab...")
+    access_token = access_tokens[login]
 
     project = project.replace("/", "%2F")
     r = await get(f"https://gitlab.com/api/v4/projects/{project}/hooks?access_token={access_token}")
@@ -0,0 +1,143 @@
+import sqlite3
+
+# Maps Git commits to Pijul patches (and back) per branch. `origin` tells
+# which side the change was authored on: "git" for commits imported to Pijul,
+# "pijul" for patches exported to Git. Git commits that were handled without
+# recording a patch (fast-forwards) are stored with a NULL patch.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (
+    commit_id TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    patch_id TEXT,
+    origin TEXT NOT NULL,
+    PRIMARY KEY (commit_id, branch)
+);
+CREATE INDEX IF NOT EXISTS commits_patch ON commits (patch_id, branch);
+CREATE INDEX IF NOT EXISTS commits_branch ON commits (branch);
+CREATE TABLE IF NOT EXISTS watermarks (
+    branch TEXT PRIMARY KEY,
+    patch_id TEXT NOT NULL,
+    commit_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    step TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    commit_id TEXT,
+    patch_id TEXT,
+    PRIMARY KEY (step, branch)
+);
+"""
+
+
+def open(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def add(db, commit, branch, patch, origin):
+    db.execute(
+        "INSERT OR REPLACE INTO commits (commit_id, branch, patch_id, origin) VALUES (?, ?, ?, ?)",
+        (commit, branch, patch, origin)
+    )
+    db.commit()
+
+
+def forgetPatch(db, patch, branch):
+    # The patch was reverted on this branch
+    db.execute(
+        "DELETE FROM commits WHERE patch_id = ? AND branch = ? AND origin = 'pijul'",
+        (patch, branch)
+    )
+    db.commit()
+
+
+def forgetExport(db, commit, branch):
+    # The exported commit is no longer on this branch
+    db.execute(
+        "DELETE FROM commits WHERE commit_id = ? AND branch = ? AND origin = 'pijul'",
+        (commit, branch)
+    )
+    db.commit()
+
+
+def lookup(db, commit, branch):
+    # Returns (patch, origin) or None if the commit wasn't handled on this branch
+    return db.execute(
+        "SELECT patch_id, origin FROM commits WHERE commit_id = ? AND branch = ?",
+        (commit, branch)
+    ).fetchone()
+
+
+def findPatch(db, commit):
+    # Returns a patch the Git commit was imported as on any branch
+    row = db.execute(
+        "SELECT patch_id FROM commits WHERE commit_id = ? AND origin = 'git' AND patch_id IS NOT NULL LIMIT 1",
+        (commit,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def getFrontier(db, branch):
+    # Returns the Git commit handled on this branch last. Commits are handled
+    # parents first, so everything behind it was handled too.
+    row = db.execute(
+        "SELECT commit_id FROM commits WHERE branch = ? ORDER BY rowid DESC LIMIT 1",
+        (branch,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def listExported(db, branch):
+    # Returns {patch: commit} for patches exported to Git on this branch
+    rows = db.execute(
+        "SELECT patch_id, commit_id FROM commits WHERE branch = ? AND origin = 'pijul' AND patch_id IS NOT NULL",
+        (branch,)
+    )
+    return dict(rows)
+
+
+# A watermark is the newest Pijul patch of a branch that was looked at during
+# the last export, together with the Git commit the branch was at afterwards.
+# Everything older than that doesn't have to be looked at again.
+def getWatermark(db, branch):
+    return db.execute(
+        "SELECT patch_id, commit_id FROM watermarks WHERE branch = ?",
+        (branch,)
+    ).fetchone()
+
+def setWatermark(db, branch, patch, commit):
+    db.execute(
+        "INSERT OR REPLACE INTO watermarks (branch, patch_id, commit_id) VALUES (?, ?, ?)",
+        (branch, patch, commit)
+    )
+    db.commit()
+
+
+# The journal lists steps of a sync that change the repositories and were
+# started but not finished, so that an interrupted sync can be resumed or
+# rolled back:
+# - "record": importing Git commit commit_id to the branch; patch_id is set
+#   once the patch is recorded in the import copy,
+# - "commit": exporting Pijul patches to the Git branch,
+# - "push": pushing the Git branch,
+# - "pijul-push": pushing the Pijul repository (branch is empty).
+# There's at most one entry per step and branch.
+def begin(db, step, branch, commit=None, patch=None):
+    db.execute(
+        "INSERT OR REPLACE INTO journal (step, branch, commit_id, patch_id) VALUES (?, ?, ?, ?)",
+        (step, branch, commit, patch)
+    )
+    db.commit()
+
+def end(db, step, branch):
+    db.execute(
+        "DELETE FROM journal WHERE step = ? AND branch = ?",
+        (step, branch)
+    )
+    db.commit()
+
+def listJournal(db):
+    # Returns (step, branch, commit, patch) of unfinished steps
+    return db.execute("SELECT step, branch, commit_id, patch_id FROM journal").fetchall()
@@ -0,0 +1,91 @@
+import asyncio
+from . import command
+
+# Blob ID Git reports for a path that doesn't exist on one side of a diff
+NULL_BLOB = "0" * 40
+
+# Blobs are copied to files in chunks of that many bytes
+CHUNK_SIZE = 1 << 20
+
+
+async def start(path):
+    # `--batch-check` tells sizes without sending the contents, so that huge
+    # blobs are never read just to find out they're huge
+    batch = await command.spawn(["git", "cat-file", "--batch"], cwd=path)
+    check = await command.spawn(["git", "cat-file", "--batch-check"], cwd=path)
+    # Requests of concurrent callers must not interleave
+    return {"batch": batch, "check": check, "lock": asyncio.Lock()}
+
+async def stop(cat):
+    for handle in (cat["batch"], cat["check"]):
+        await command.finish(handle)
+
+
+async def request(handle, blob):
+    # Returns the size of the blob, or None if there is no such blob. The
+    # caller has to rest() the command once the answer is read.
+    proc = handle["proc"]
+    command.touch(handle)
+    try:
+        proc.stdin.write(f"{blob}\n".encode())
+        await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        raise command.failure(handle)
+    # The header is "<id> <type> <size>" or "<id> missing"
+    header = (await proc.stdout.readline()).decode().split()
+    if header == []:
+        raise command.failure(handle)
+    if header[1] == "missing":
+        return None
+    return int(header[2])
+
+async def readexactly(handle, length):
+    try:
+        return await handle["proc"].stdout.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise command.failure(handle)
+
+async def size(cat, blob):
+    # Returns the size of the blob, or None if there is no such blob
+    if blob == NULL_BLOB:
+        return None
+    async with cat["lock"]:
+        length = await request(cat["check"], blob)
+        command.rest(cat["check"])
+    return length
+
+async def read(cat, blob):
+    # Returns the contents of the blob, or None if there is no such blob
+    if blob == NULL_BLOB:
+        return None
+    handle = cat["batch"]
+    async with cat["lock"]:
+        length = await request(handle, blob)
+        if length is None:
+            command.rest(handle)
+            return None
+        data = await readexactly(handle, length + 1)
+        command.rest(handle)
+    return data[:-1]
+
+async def copy(cat, blob, path):
+    # Writes the blob to path without holding it in memory. Returns False if
+    # there is no such blob
+    if blob == NULL_BLOB:
+        return False
+    handle = cat["batch"]
+    async with cat["lock"]:
+        length = await request(handle, blob)
+        if length is None:
+            command.rest(handle)
+            return False
+        with open(path, "wb") as f:
+            while length > 0:
+                # Every chunk is a sign of life
+                command.touch(handle)
+                chunk = await readexactly(handle, min(length, CHUNK_SIZE))
+                f.write(chunk)
+                length -= len(chunk)
+        await readexactly(handle, 1)
+        command.rest(handle)
+    return True
@@ -5,6 +5,9 @@ import chalk
 
 hook_supported_hosts = ("nest.pijul.com",)
 
+# Nest keeps the session in a cookie, so only one user is logged in at a time
+logged_in_as = None
+
 def getUrlHost(url):
     try:
         if url.startswith("https://"):
@@ -30,6 +33,7 @@ def getUrlRepository(url):
 
 
 async def authorize(host, login, password):
+    global logged_in_as
     if host == "nest.pijul.com":
         res = await post("https://nest.pijul.com?login", {
             "login": login,
@@ -37,6 +41,7 @@ async def authorize(host, login, password):
         })
         cookies = www.session.cookie_jar.filter_cookies("https://nest.pijul.com")
         if "token" in cookies.keys():
+            logged_in_as = login
             return "ok"
         else:
             return "Unknown error (most likely wrong login/password)"
@@ -0,0 +1,153 @@
+from .sync import sync
+from .command import redact
+import asyncio
+import collections
+import contextlib
+import itertools
+import time
+import chalk
+
+# Mirror pair -> scheduling state
+pairs = {}
+
+# Recent jobs, both finished and not
+jobs = collections.deque(maxlen=100)
+job_ids = itertools.count(1)
+
+# Syncs of all pairs share these slots. A semaphore lets waiters in in the
+# order they came, so every pair that waits gets its turn before any pair gets
+# a second one.
+MAX_SYNCS = 4
+slots = None
+
+def setMaxSyncs(count):
+    global slots
+    slots = asyncio.Semaphore(count)
+
+
+# Repository URL -> lock, as pairs may share repositories
+repo_locks = {}
+
+
+def getPair(config):
+    key = (config["git"]["url"], config["pijul"]["url"])
+    if key not in pairs:
+        pairs[key] = {
+            "task": None,
+            "queued": None,
+            "triggers": 0,
+            "syncs": 0
+        }
+    return pairs[key]
+
+def stats(config):
+    pair = getPair(config)
+    return {
+        "triggers": pair["triggers"],
+        "syncs": pair["syncs"],
+        "running": pair["task"] is not None
+    }
+
+
+@contextlib.asynccontextmanager
+async def lock(config):
+    # Held while syncing, so that it's safe to touch the working copies. The
+    # locks are always taken in the same order, so pairs sharing a repository
+    # can't deadlock.
+    async with contextlib.AsyncExitStack() as stack:
+        for url in sorted({config["git"]["url"], config["pijul"]["url"]}):
+            if url not in repo_locks:
+                repo_locks[url] = asyncio.Lock()
+            await stack.enter_async_context(repo_locks[url])
+        yield
+
+
+def describe(job):
+    return {
+        key: value
+        for key, value in job.items()
+        if key not in ("done", "exception")
+    }
+
+def findJob(job_id):
+    for job in jobs:
+        if job["id"] == job_id:
+            return job
+    return None
+
+
+def enqueue(config, target=None):
+    # Request a sync without waiting for it. At most one sync per mirror pair
+    # runs at a time; requests arriving meanwhile are coalesced into a single
+    # queued job, which is returned. If target is passed, only the change it
+    # describes is synced, unless some other request needs a full sync.
+    pair = getPair(config)
+    pair["triggers"] += 1
+    job = pair["queued"]
+    if job is None:
+        job = {
+            "id": next(job_ids),
+            # Jobs are served publicly, so URLs go without credentials
+            "git": redact(config["git"]["url"]),
+            "pijul": redact(config["pijul"]["url"]),
+            "status": "queued",
+            "triggers": 0,
+            "targets": [],
+            "queued_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "duration": None,
+            "error": None,
+            "exception": None,
+            "done": asyncio.get_running_loop().create_future()
+        }
+        pair["queued"] = job
+        jobs.append(job)
+    job["triggers"] += 1
+    if target is None:
+        job["targets"] = None
+    elif job["targets"] is not None:
+        job["targets"].append(target)
+    if pair["task"] is None:
+        pair["task"] = asyncio.create_task(worker(config, pair))
+    return job
+
+async def trigger(config, target=None):
+    # Request a sync and wait for it to finish
+    job = enqueue(config, target)
+    await asyncio.shield(job["done"])
+    if job["exception"] is not None:
+        raise job["exception"]
+
+async def worker(config, pair):
+    try:
+        while pair["queued"] is not None:
+            # Wait for the burst of triggers to settle down
+            await asyncio.sleep(config.get("debounce", 1))
+            if slots is None:
+                setMaxSyncs(MAX_SYNCS)
+            # Triggers arriving while waiting still go to this job. Pairs sharing
+            # a repository wait for each other without taking a slot.
+            async with lock(config), slots:
+                job, pair["queued"] = pair["queued"], None
+                pair["syncs"] += 1
+
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                try:
+                    await sync(config, job["targets"])
+                except Exception as e:
+                    print(chalk.red(f"  Sync of {config['git']['url']} failed: {e}"))
+                    job["status"] = "failed"
+                    job["error"] = redact(str(e))
+                    job["exception"] = e
+                else:
+                    job["status"] = "finished"
+                job["finished_at"] = time.time()
+                job["duration"] = job["finished_at"] - job["started_at"]
+                job["done"].set_result(None)
+
+            triggers, syncs = pair["triggers"], pair["syncs"]
+            print(f"  Triggers received: {triggers}, syncs executed: {syncs}")
+    finally:
+        pair["task"] = None
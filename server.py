@@ -4,11 +4,12 @@ import asyncio
 import chalk
 import miniupnpc
 import json
-from . import git, pijul
-from .sync import sync
+import re
+from . import git, pijul, scheduler, command
 
 
-config = None
+# Mirror pairs webhooks are routed to
+configs = []
 
 
 async def start_somewhere(runner):
@@ -43,8 +44,8 @@ async def start_somewhere(runner):
 
 
 async def start(onBind, c):
-    global config
-    config = c
+    global configs
+    configs = c
 
     import logging
     logger = logging.Logger("server")
@@ -54,6 +55,9 @@ async def start(onBind, c):
     app = web.Application()
     app.add_routes([web.post("/fromGitlab", fromGitlab)])
     app.add_routes([web.post("/fromNest", fromNest)])
+    app.add_routes([web.get("/jobs", listJobs)])
+    app.add_routes([web.get("/jobs/{id}", getJob)])
+    app.add_routes([web.get("/commands", listCommands)])
     runner = web.AppRunner(app, logger=logger)
     await runner.setup()
 
@@ -75,23 +79,111 @@ async def start(onBind, c):
             await onBind(f"{cur_ip}:{port}")
 
 
+def accepted(jobs):
+    # The sync itself runs in background so that the hosting doesn't time out
+    # waiting for it and retry the webhook
+    return web.json_response({
+        "jobs": [{"job": job["id"], "status": job["status"]} for job in jobs]
+    }, status=202)
+
+
+def gitlabTarget(r):
+    # Returns the change described by a push event, or None if the event
+    # doesn't describe a plain push to a branch
+    null = "0" * 40
+    ref = r.get("ref")
+    before = r.get("before")
+    after = r.get("after")
+    if not isinstance(ref, str) or not ref.startswith("refs/heads/"):
+        return None
+    if not all(isinstance(commit, str) and re.fullmatch("[0-9a-f]{40}", commit) for commit in (before, after)):
+        return None
+    if before == null or after == null:
+        # Branch creation or deletion
+        return None
+    return {
+        "kind": "git",
+        "branch": ref[len("refs/heads/"):],
+        "before": before,
+        "after": after
+    }
+
+
+def nestTarget(r):
+    # Returns the patches described by a NewPatches event, or None if the
+    # event doesn't list them
+    branch = r.get("branch")
+    patches = r.get("patches")
+    if not isinstance(branch, str) or not re.fullmatch(r"[\w.\-/]+", branch):
+        return None
+    if not isinstance(patches, list) or patches == []:
+        return None
+    if not all(isinstance(patch, str) and re.fullmatch("[1-9A-HJ-NP-Za-km-z]+", patch) for patch in patches):
+        return None
+    return {
+        "kind": "pijul",
+        "branch": branch,
+        "patches": patches
+    }
+
+
+def isProject(vcs, url, project):
+    # Pairs with URLs the hosting helpers don't understand can't get webhooks
+    try:
+        return vcs.getUrlRepository(url) == project
+    except (NotImplementedError, IndexError):
+        return False
+
+
 async def fromGitlab(req):
-    r = json.loads(await req.read())
-    if r["project"]["path_with_namespace"] == git.getUrlRepository(config["git"]["url"]):
-        # This check isn't for security -- it's to avoid accidental calls
-        await sync(config)
-        return web.Response(text="ok")
+    try:
+        r = json.loads(await req.read())
+        project = r["project"]["path_with_namespace"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(text="Error: Malformed payload", status=400)
+    # This check isn't for security -- it's to avoid accidental calls
+    matching = [config for config in configs if isProject(git, config["git"]["url"], project)]
+    if matching != []:
+        return accepted([scheduler.enqueue(config, gitlabTarget(r)) for config in matching])
     return web.Response(text="Error: Wrong repository")
 
 async def fromNest(req):
-    r = json.loads(await req.read())
+    try:
+        r = json.loads(await req.read())
+    except ValueError:
+        return web.Response(text="Error: Malformed payload", status=400)
     if "NewPatches" in r:
         r = r["NewPatches"]
-        repo_owner = r["repository_owner"]
-        repo_name = r["repository_name"]
-        if f"{repo_owner}/{repo_name}" == pijul.getUrlRepository(config["pijul"]["url"]):
-            # This check isn't for security -- it's to avoid accidental calls
-            await sync(config)
-            return web.Response(text="ok")
+        try:
+            repo_owner = r["repository_owner"]
+            repo_name = r["repository_name"]
+        except (KeyError, TypeError):
+            return web.Response(text="Error: Malformed payload", status=400)
+        # This check isn't for security -- it's to avoid accidental calls
+        matching = [config for config in configs if isProject(pijul, config["pijul"]["url"], f"{repo_owner}/{repo_name}")]
+        if matching != []:
+            return accepted([scheduler.enqueue(config, nestTarget(r)) for config in matching])
         return web.Response(text="Error: Wrong repository")
-    return web.Response(text="Error: No new patches")
\ No newline at end of file
+    return web.Response(text="Error: No new patches")
+
+
+async def listJobs(req):
+    return web.json_response({
+        "pairs": [
+            {"git": command.redact(config["git"]["url"]), "pijul": command.redact(config["pijul"]["url"]), **scheduler.stats(config)}
+            for config in configs
+        ],
+        "jobs": [scheduler.describe(job) for job in scheduler.jobs]
+    })
+
+async def getJob(req):
+    try:
+        job = scheduler.findJob(int(req.match_info["id"]))
+    except ValueError:
+        job = None
+    if job is None:
+        return web.Response(text="Error: No such job", status=404)
+    return web.json_response(scheduler.describe(job))
+
+async def listCommands(req):
+    return web.json_response(list(command.history))
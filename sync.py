@@ -1,126 +1,585 @@
-from . import git, pijul
+from . import git, pijul, mapping, objects, exporter
+from .command import run, stream
 import asyncio
+import concurrent.futures
+import fcntl
+import glob
 import hashlib
+import io
+import multiprocessing
 import os
-import shlex
+import re
+import shutil
+import time
 import chalk
 import merge3
 import datetime
 
-handled_git_commits = []
+def toLines(data):
+    # Split like readlines() on a file opened in text mode would
+    if data is None:
+        return None
+    return io.TextIOWrapper(io.BytesIO(data)).readlines()
 
 
-async def run(cmd):
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL
-    )
+# Working copies, indexes and journals are kept there. Overridden by the
+# "state_dir" config key.
+STATE_DIR = "/tmp"
+state_dir = STATE_DIR
+
+# Working copy -> lock file, held as long as the process runs
+state_locks = {}
+
+def setStateDir(path):
+    global state_dir
+    state_dir = os.path.abspath(os.path.expanduser(path))
+    os.makedirs(state_dir, exist_ok=True)
+
+def lockWorkingCopy(url):
+    # Returns False if another process uses the working copy
+    path = urlToPath(url)
+    if path in state_locks:
+        return True
+    f = open(f"{path}.lock", "w")
     try:
-        stdout, _ = await proc.communicate()
-    except asyncio.CancelledError:
-        proc.terminate()
-        return ""
-    return stdout.decode()
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    state_locks[path] = f
+    return True
+
+# Bare repository holding Git objects shared by all working copies, or None.
+# Set by the "object_pool" config key.
+object_pool = None
+
+async def setObjectPool(path):
+    global object_pool
+    object_pool = os.path.abspath(os.path.expanduser(path))
+    await run(["git", "init", "-q", "--bare", object_pool])
+    # Working copies rely on the objects, so they must never be pruned
+    await run(["git", "config", "gc.auto", "0"], cwd=object_pool)
 
+async def fillObjectPool(url, branch="*"):
+    # Fetch the repository to the pool, so that objects shared with other
+    # repositories are only downloaded once. Every repository gets its own
+    # refs there, which keep its objects alive.
+    name = hashlib.sha256(url.encode()).hexdigest()[:16]
+    print("  Git: Filling the object pool...")
+    if await run(["git", "fetch", "-q", url, f"+refs/heads/{branch}:refs/pool/{name}/heads/{branch}"], cwd=object_pool, check=True) is None:
+        print(chalk.yellow("  Failed to fill the object pool"))
+
+def useObjectPool(path):
+    # Let an existing working copy borrow objects from the pool
+    alternates = f"{path}/.git/objects/info/alternates"
+    objects = f"{object_pool}/objects"
+    lines = []
+    if os.path.isfile(alternates):
+        with open(alternates) as f:
+            lines = f.read().split("\n")
+    if objects not in lines:
+        with open(alternates, "a") as f:
+            f.write(f"{objects}\n")
 
 def urlToPath(url):
-    return "/tmp/" + hashlib.sha256(url.encode()).hexdigest()[:16]
+    return f"{state_dir}/" + hashlib.sha256(url.encode()).hexdigest()[:16]
 
-async def pullGit(url):
-    # Check whether we have the repo downloaded already
+def indexPath(git_url, pijul_url):
+    return f"{state_dir}/" + hashlib.sha256(f"{git_url} {pijul_url}".encode()).hexdigest()[:16] + ".sqlite"
+
+async def listGitBranches(path, prefix="refs/heads/"):
+    # Returns {branch: commit} of local branches, or of remote ones if the
+    # prefix is "refs/remotes/origin/"
+    branches = {}
+    async for r in stream(["git", "for-each-ref", "--format=%(refname) %(objectname)", prefix], cwd=path):
+        if r != "":
+            ref, commit = r.split(" ")
+            if ref != f"{prefix}HEAD":
+                branches[ref[len(prefix):]] = commit
+    return branches
+
+async def isAncestor(path, ancestor, commit):
+    return await run(["git", "merge-base", "--is-ancestor", ancestor, commit], cwd=path, check=True) is not None
+
+async def hasOnlyExports(path, base, commit):
+    # Returns whether all commits in base..commit were exported from Pijul
+    async for message in stream(["git", "log", "--format=%x00%B", f"{base}..{commit}"], cwd=path, sep="\0"):
+        lines = message.split("\n")
+        if message != "" and not any(line.startswith(("Imported from Pijul patch ", "Reverted Pijul patch ")) for line in lines):
+            return False
+    return True
+
+async def updateBranches(path, only=None, force=True):
+    # Move local branches to where they are in origin. Branches that are
+    # ahead of origin only by exports keep them until they're pushed.
+    # Branches that diverged from it, because of a force-push or a push
+    # racing ours, are reset to origin if force is set, and left alone
+    # otherwise. Returns {branch: old commit} of the diverged branches.
+    local = await listGitBranches(path)
+    remote = await listGitBranches(path, "refs/remotes/origin/")
+    diverged = {}
+    updates = []
+    for branch, commit in remote.items():
+        if only is not None and branch not in only:
+            continue
+        old = local.get(branch)
+        if old == commit:
+            continue
+        if old is not None and await isAncestor(path, commit, old) and await hasOnlyExports(path, commit, old):
+            continue
+        if old is not None and not await isAncestor(path, old, commit):
+            diverged[branch] = old
+            if not force:
+                print(chalk.yellow(f"  Branch {branch} diverged from origin"))
+                continue
+            print(chalk.yellow(f"  Branch {branch} diverged from origin, resetting it"))
+        updates.append(f"update refs/heads/{branch} {commit}\n")
+    if updates != []:
+        await run(["git", "update-ref", "--stdin"], cwd=path, input="".join(updates))
+    return diverged
+
+async def forgetUnpushed(db, git, pijul, reset):
+    # The branches were reset to origin, so the commits exported to them that
+    # never got pushed are gone. They're exported anew from a new export copy.
+    for branch, old in reset.items():
+        shutil.rmtree(scratchPath(git, pijul, branch), ignore_errors=True)
+        if db is None:
+            # The index is rebuilt from what's in Git
+            continue
+        async for commit in stream(["git", "rev-list", old, f"^refs/heads/{branch}"], cwd=git):
+            if commit != "":
+                mapping.forgetExport(db, commit, branch)
+        mapping.end(db, "push", branch)
+
+def isCommit(since):
+    return re.fullmatch(r"[0-9a-f]{7,40}", since) is not None
+
+def parseDate(date):
+    # Dates without a timezone are in UTC
+    date = datetime.datetime.fromisoformat(date.replace(" UTC", ""))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+def cloneOptions(since):
+    # If mirroring starts at a commit or a date, older history isn't needed:
+    # blobs are only fetched when they're read, and commits older than the
+    # date aren't fetched at all
+    if since is None:
+        return []
+    if isCommit(since):
+        return ["--filter=blob:none"]
+    return ["--filter=blob:none", f"--shallow-since={since}"]
+
+def fetchOptions(path, since):
+    # Keep a shallow clone shallow when new branches come
+    if since is None or isCommit(since) or not os.path.isfile(f"{path}/.git/shallow"):
+        return []
+    return [f"--shallow-since={since}"]
+
+async def pullGit(url, since=None):
+    # Check whether we have the repo downloaded already. The worktree is never
+    # used, so it's not checked out. Partial clones can't borrow objects from
+    # the pool.
     path = urlToPath(url)
+    pooled = object_pool is not None and since is None
+    if pooled:
+        # Objects that are in the pool already aren't fetched again below
+        await fillObjectPool(url)
     if os.path.isdir(path):
         print(f"  Git: Fetching {url} to {path}...")
-        await run(f"cd {path}; git fetch")
-        for r in (await run(f"cd {path}; git branch -r")).split("\n"):
-            r = r[2:]
-            if r.startswith("origin/"):
-                branch = r.split("/", 1)[1]
-                if not branch.startswith("HEAD -> "):
-                    await run(f"cd {path}; git checkout {branch}")
-        print(chalk.green("  Done."))
+        if pooled:
+            useObjectPool(path)
+        old = await listGitBranches(path)
     else:
         print(f"  Git: Cloning {url} to {path}...")
-        await run(f"cd /tmp; git clone \"{url}\" {path}")
-        print(chalk.green("  Done."))
+        reference = ["--reference", object_pool] if pooled else []
+        await run(["git", "clone", "--no-checkout", *reference, *cloneOptions(since), url, path])
+        old = {}
+    # Local branches are then updated right in refs. Returns {branch: old
+    # commit} of the branches that were reset.
+    if await run(["git", "fetch", "origin", *fetchOptions(path, since), "--prune", "+refs/heads/*:refs/remotes/origin/*"], cwd=path, check=True) is None:
+        print(chalk.red(f"  Failed to fetch {url}"))
+        return {}
+    reset = await updateBranches(path)
+    new = await listGitBranches(path)
+    # Only reported: branches left behind by a failed sync still need work,
+    # so what to import is decided by the index
+    updated = [branch for branch in new if old.get(branch) != new[branch]]
+    print(chalk.green(f"  Done. {len(updated)} branches updated"))
+    return reset
 
 async def pullPijul(url):
     # Check whether we have the repo downloaded already
     path = urlToPath(url)
     if os.path.isdir(path):
         print(f"  Pijul: Fetching {url} to {path}...")
-        await run(f"cd {path}; pijul pull --all")
+        await run(["pijul", "pull", "--all"], cwd=path)
         print(chalk.green("  Done."))
     else:
         print(f"  Pijul: Cloning {url} to {path}...")
-        await run(f"mkdir {path}; cd {path}; pijul init; pijul pull --set-default --set-remote origin \"{url}\" --all")
+        os.mkdir(path)
+        await run(["pijul", "init"], cwd=path)
+        await run(["pijul", "pull", "--set-default", "--set-remote", "origin", url, "--all"], cwd=path)
         print(chalk.green("  Done."))
 
 
-async def presyncGitToPijul(git, pijul):
-    print("  Collecting new Git commits...")
-    commits = []
-    for r in (await run(f"cd {git}; git for-each-ref --format '%(refname) %(objectname)'")).split("\n"):
+async def remoteGitState(url):
+    # Returns the tips of remote branches and tags, or None if the remote is
+    # unreachable
+    return await run(["git", "ls-remote", "--heads", "--tags", url], check=True)
+
+async def remotePijulState(url):
+    # Pijul can't list remote patches without pulling them, so pull and return
+    # a digest of the local patch lists. Returns None if there's no working
+    # copy yet or the remote is unreachable.
+    path = urlToPath(url)
+    if not os.path.isdir(path):
+        return None
+    if await run(["pijul", "pull", "--all"], cwd=path, check=True) is None:
+        return None
+    state = hashlib.sha256()
+    for r in (await run(["pijul", "branches"], cwd=path)).split("\n"):
         if r == "":
             continue
-        ref, commit = r.split(" ")
-        if ref.startswith("refs/heads/"):
-            branch = ref.split("/", 2)[2]
-            commits += [(commit, branch) for commit in await presyncGitToPijulCommit(git, pijul, commit, branch)]
-    return commits
+        branch = r[2:]
+        state.update(f"{branch}\n".encode())
+        async for line in stream(["pijul", "log", "--hash-only", "--branch", branch], cwd=path):
+            state.update(f"{line}\n".encode())
+    return state.hexdigest()
 
-async def presyncGitToPijulCommit(git, pijul, commit, branch):
-    # Check whether Pijul repo has this commit imported already
-    r = await run(f"cd {pijul}; pijul log --grep 'Imported from Git commit {commit}' --hash-only --branch {branch}")
-    for patch_id in r.split("\n"):
-        patch_id = patch_id.split(":")[0]
-        if len(patch_id) == 88:  # this is to avoid repository id to be treated as a patch
-            desc = await run(f"cd {pijul}; pijul patch --description {patch_id}")
-            if desc.strip() == f"Imported from Git commit {commit}":
-                # Yay, exported to Pijul already
-                return []
-    if (commit, branch) in handled_git_commits:
-        # Exported to Pijul already
-        return []
 
-    # Check whether this is an imported commit
-    message_lines = (await run(f"cd {git}; git log -1 --format=%B {commit}")).split("\n")
-    if any((line.startswith("Imported from Pijul patch ") for line in message_lines)):
+async def rebuildIndex(db, git, pijul):
+    print("  Rebuilding commit index...")
+
+    # Commits are added oldest first, as they would be when syncing, so that
+    # the frontiers are right. Git commits imported to Pijul:
+    for r in (await run(["pijul", "branches"], cwd=pijul)).split("\n"):
+        if r == "":
+            continue
+        branch = r[2:]
+        imported = []
+        async for patch in readPijulLog(pijul, branch):
+            for line in patch["message"].split("\n"):
+                if line.startswith("Imported from Git commit "):
+                    imported.append((line.split()[-1], patch["patch_id"]))
+        for commit, patch_id in imported[::-1]:
+            mapping.add(db, commit, branch, patch_id, "git")
+
+    # Pijul patches exported to Git
+    for branch in await listGitBranches(git):
+        for commit, patch_id in (await listExportedPatches(git, branch))[::-1]:
+            mapping.add(db, commit, branch, patch_id, "pijul")
+
+    print(chalk.green("  Done."))
+
+
+async def readCutoff(git, since):
+    # Returns the date history is mirrored from, or None if it's mirrored
+    # whole. since is a commit or an ISO 8601 date.
+    if since is None:
+        return None
+    if isCommit(since):
+        date = await run(["git", "log", "-1", "--format=%cI", since], cwd=git, check=True)
+        if date is None or date.strip() == "":
+            print(chalk.yellow(f"  Commit {since} to mirror from is unknown, mirroring everything"))
+            return None
+        return parseDate(date.strip())
+    return parseDate(since)
+
+def readShallow(git):
+    # Returns the oldest commits of a shallow clone. Their parents are
+    # missing, so they can't be imported and mirroring starts after them.
+    if not os.path.isfile(f"{git}/.git/shallow"):
         return []
+    with open(f"{git}/.git/shallow") as f:
+        return f.read().split()
 
-    # Not imported, make sure all its parents are imported first
-    r = await run(f"cd {git}; git show -s --pretty=%P {commit}")
-    commits = []
-    for parent in r.split():
-        if parent != "":
-            commits += await presyncGitToPijulCommit(git, pijul, parent, branch)
-    return commits + [commit]
+async def readGitCommits(db, git, tips, since=None):
+    # Read metadata of all commits that may need to be imported, in a single
+    # pass per branch. Everything up to the commit handled on the branch last
+    # is excluded, and so is the history before the commit or the date
+    # mirroring starts at.
+    if tips == []:
+        return {}
+    common = ["^" + commit for commit in readShallow(git)]
+    options = []
+    if since is not None and isCommit(since):
+        # Not a date filter: with clock skew, that would drop descendants
+        common.append("^" + since)
+    else:
+        cutoff = await readCutoff(git, since)
+        if cutoff is not None:
+            options.append(f"--since={cutoff.isoformat()}")
 
+    commits = {}
+    for tip, branch in tips:
+        revs = [tip] + common
+        # The frontier of one branch may be far ahead of another one, so
+        # branches aren't read together
+        frontier = mapping.getFrontier(db, branch)
+        if frontier is not None:
+            revs.append("^" + frontier)
+        await readGitLog(git, revs, options, commits)
+    return commits
 
-async def syncGitToPijul(git, pijul, presync):
-    print("  Syncing Git -> Pijul...")
+async def readGitLog(git, revs, options, commits):
+    # Add the commits git log lists for revs to commits
+    log = stream(
+        ["git", "log", "--stdin", "--ignore-missing", *options, "--raw", "-z", "--no-abbrev", "--no-renames", "--format=%x1E%H%x1F%P%x1F%an <%ae>%x1F%ci%x1F%B%x1F"],
+        cwd=git,
+        input="".join(rev + "\n" for rev in revs),
+        sep="\x1E"
+    )
+    async for record in log:
+        if record == "":
+            continue
+        commit, parents, author, date, message, raw = record.split("\x1F", 5)
+        if commit in commits:
+            continue
+        # Raw diff entries are ":<modes> <base blob> <blob> <status>\0<path>\0"
+        raw = raw.lstrip("\0\n").split("\0")
+        files = []
+        for meta, path in zip(raw[::2], raw[1::2]):
+            _, _, base_blob, blob, _ = meta.split(" ")
+            files.append({
+                "path": path,
+                "base_blob": base_blob,
+                "blob": blob
+            })
+        commits[commit] = {
+            "parents": parents.split(),
+            "author": author,
+            "date": date,
+            "message": message,
+            "files": files
+        }
+
+async def presyncGitToPijul(db, git, pijul, since=None):
+    print("  Collecting new Git commits...")
+    tips = []
+    for branch, commit in (await listGitBranches(git)).items():
+        # Branches that didn't change since they were handled have nothing new
+        if mapping.lookup(db, commit, branch) is None:
+            tips.append((commit, branch))
+
+    git_commits = await readGitCommits(db, git, tips, since=since)
+
+    return planGitToPijul(db, git_commits, tips), git_commits
+
+def planGitToPijul(db, git_commits, tips):
+    # Walk the history from all branch tips and list (commit, branch) pairs to
+    # import, parents first. The walk is iterative so that long histories
+    # don't hit the recursion limit, and each commit is examined only once
+    # per branch no matter how many merges lead to it.
+    stops = {}
+    plan = []
+    for tip, branch in tips:
+        visited = set()
+        stack = [(tip, False)]
+        while stack:
+            commit, expanded = stack.pop()
+            if expanded:
+                # All parents are planned already
+                plan.append((commit, branch))
+                continue
+            if commit in visited:
+                continue
+            visited.add(commit)
+
+            if commit not in stops:
+                if commit not in git_commits:
+                    # Settled commits are not read at all
+                    stops[commit] = True
+                else:
+                    # Check whether this is an imported commit
+                    message_lines = git_commits[commit]["message"].split("\n")
+                    stops[commit] = any((line.startswith("Imported from Pijul patch ") for line in message_lines))
+            if stops[commit]:
+                continue
+            # Check whether Pijul repo has this commit imported already
+            if mapping.lookup(db, commit, branch) is not None:
+                continue
+
+            # Not imported, make sure all its parents are imported first
+            stack.append((commit, True))
+            for parent in reversed(git_commits[commit]["parents"]):
+                if parent not in visited:
+                    stack.append((parent, False))
+    return plan
+
+
+# Branches synced at once, unless configured otherwise
+BRANCH_WORKERS = 4
+
+async def gatherAll(coros):
+    # Like asyncio.gather, but lets every coroutine finish before raising the
+    # first exception
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def groupByBranch(presync):
+    # Split the import plan into groups of branches that can be imported
+    # independently. Branches sharing commits stay in one group, so that a
+    # shared commit is recorded once and reapplied to the other branches.
+    parent = {}
+    def find(branch):
+        while parent.setdefault(branch, branch) != branch:
+            branch = parent[branch]
+        return branch
+    first_branch = {}
     for commit, branch in presync:
-        await syncGitToPijulCommit(git, pijul, commit, branch)
+        parent[find(branch)] = find(first_branch.setdefault(commit, branch))
+    groups = {}
+    for commit, branch in presync:
+        groups.setdefault(find(branch), []).append((commit, branch))
+    return list(groups.values())
+
+async def syncGitToPijul(db, git, pijul, presync, git_commits, config):
+    print("  Syncing Git -> Pijul...")
+    cat = await objects.start(git)
+    limit = asyncio.Semaphore(config.get("branch_workers", BRANCH_WORKERS))
+    # Held while the main repository is changed
+    lock = asyncio.Lock()
+
+    async def syncGroup(group):
+        async with limit:
+            copies = {}
+            for commit, branch in group:
+                if branch not in copies:
+                    copies[branch] = await openImportCopy(pijul, branch, lock)
+                if not await syncGitToPijulCommit(db, cat, pijul, copies[branch], lock, commit, branch, git_commits[commit], config):
+                    # Later commits would become the frontier and hide this
+                    # one, so it's retried with them next time
+                    print(chalk.red(f"  Stopped importing branch {branch} and the branches sharing commits with it"))
+                    return
+
     if presync != []:
-        print("  Pushing...")
-        await run(f"cd {pijul}; pijul push --all")
+        mapping.begin(db, "pijul-push", "")
+    try:
+        await gatherAll(syncGroup(group) for group in groupByBranch(presync))
+    finally:
+        await objects.stop(cat)
+    if presync != []:
+        await pushPijul(db, pijul)
 
-async def syncGitToPijulCommit(git, pijul, commit, branch):
-    # Check whether Pijul repo has this commit imported already
-    # Notice that this duplicates code from presyncGitToPijulCommit, however,
-    # this additional check will stop the commits from being duplicated.
-    r = await run(f"cd {pijul}; pijul log --grep 'Imported from Git commit {commit}' --hash-only --branch {branch}")
-    for patch_id in r.split("\n"):
-        patch_id = patch_id.split(":")[0]
-        if len(patch_id) == 88:  # this is to avoid repository id to be treated as a patch
-            desc = await run(f"cd {pijul}; pijul patch --description {patch_id}")
-            if desc.strip() == f"Imported from Git commit {commit}":
-                # Yay, exported to Pijul already
-                return
-    if (commit, branch) in handled_git_commits:
-        # Exported to Pijul already
+async def pushPijul(db, pijul):
+    print("  Pushing...")
+    if await run(["pijul", "push", "--all"], cwd=pijul, check=True) is None:
+        print(chalk.red("  Failed to push to Pijul"))
         return
+    mapping.end(db, "pijul-push", "")
+
+def importPath(pijul, branch):
+    return f"{pijul}-import-" + hashlib.sha256(branch.encode()).hexdigest()[:16]
+
+async def openImportCopy(pijul, branch, lock):
+    # Git commits are imported in a copy of the repository per branch, so that
+    # branches can be imported at the same time. The copy is brought up to
+    # date with the branch, or made anew if it has patches the branch doesn't.
+    work = importPath(pijul, branch)
+    async with lock:
+        patches = await listPijulPatches(pijul, branch)
+        if os.path.isdir(work):
+            if not set(await listPijulPatches(work, branch)) <= set(patches):
+                shutil.rmtree(work)
+        if not os.path.isdir(work):
+            print("  Creating import copy of the branch...")
+            shutil.rmtree(f"{work}.tmp", ignore_errors=True)
+            await run(["cp", "-a", pijul, f"{work}.tmp"])
+            await run(["pijul", "checkout", branch], cwd=f"{work}.tmp")
+            # Patches are published to the main repository without updating
+            # its working copy
+            await run(["pijul", "revert", "--all", "--branch", branch], cwd=f"{work}.tmp")
+            os.rename(f"{work}.tmp", work)
+            return work
+        # Patches are listed newest first
+        present = set(await listPijulPatches(work, branch))
+        missing = [patch_id for patch_id in patches[::-1] if patch_id not in present]
+        for patch_id in missing:
+            copyPatch(pijul, work, patch_id)
+            await run(["pijul", "apply", patch_id, "--branch", branch], cwd=work)
+    await run(["pijul", "checkout", branch], cwd=work)
+    if missing != []:
+        await run(["pijul", "revert", "--all", "--branch", branch], cwd=work)
+    return work
+
+async def publishPatch(pijul, work, lock, branch, patch_id):
+    # Apply a patch from an import copy to the main repository. Returns False
+    # on failure.
+    async with lock:
+        copyPatch(work, pijul, patch_id)
+        return await run(["pijul", "apply", patch_id, "--branch", branch], cwd=pijul, check=True) is not None
+
+# Files larger than that many bytes are never merged line by line
+MERGE_SIZE_LIMIT = 16 << 20
+
+# Worker count -> process pool, as pairs may configure different counts
+merge_pools = {}
+
+def getMergePool(workers):
+    # Returns None if merges should run in this process. Pools are created
+    # once and reused by all syncs.
+    if workers == 1:
+        return None
+    if workers not in merge_pools:
+        # Forked workers would inherit the pipes of cat-file and other
+        # commands running at that moment and keep them open forever
+        merge_pools[workers] = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    return merge_pools[workers]
+
+def mergeFile(commit, file, base, ours, theirs):
+    # Returns the merged contents and the conflict message, if any. Runs on
+    # the merge pool, so it must not touch anything but its arguments.
+    merge = merge3.Merge3(base, ours, theirs, is_cherrypick=True)
+    for t in merge.merge_regions():
+        if t[0] == "conflict":
+            # Aw!..
+            header = ""
+            header += "/*\n"
+            header += " * Notice by GitPijul proxy: this file was modified by both Git and Pijul. Make\n"
+            header += " * sure to merge the conflict yourself and remove this banner.\n"
+            header += " */\n"
+            conflict = f"  Conflict: {file} modified by both Git and Pijul"
+            break
+    else:
+        # Yay! No conflicts
+        header = ""
+        conflict = None
+
+    merged = merge.merge_lines(
+        name_a="Pijul",
+        name_b=f"Git (commit {commit})",
+        start_marker=">" * 32,
+        mid_marker="=" * 32,
+        end_marker="<" * 32
+    )
+    return (header + "".join(merged)).encode(), conflict
+
+def isBinary(data):
+    # Same heuristic as Git uses: a NUL byte close to the beginning
+    return b"\0" in data[:8000]
+
+def readWorkingFile(pijul, file, size_limit):
+    # Returns the contents of a file in the Pijul working copy, or None if it's
+    # too large to be read whole
+    path = f"{pijul}/{file}"
+    if os.path.islink(path) or os.path.getsize(path) > size_limit:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+async def syncGitToPijulCommit(db, cat, pijul, work, lock, commit, branch, info, config):
+    # Returns False if the commit couldn't be imported
+    # Check whether Pijul repo has this commit imported already
+    # The plan is made before anything is imported, so check again to not
+    # import the commit twice.
+    if mapping.lookup(db, commit, branch) is not None:
+        # Yay, exported to Pijul already
+        return True
 
     # Check whether we've already imported the commit as a patch, and we can
     # reuse it. For example, look at the following tree:
@@ -134,279 +593,755 @@ async def syncGitToPijulCommit(git, pijul, commit, branch):
     # A
     #
     # In this case, we don't want to import A and B twice.
-    r = await run(f"cd {pijul}; pijul log --grep 'Imported from Git commit {commit}' --hash-only")
-    for patch_id in r.split("\n"):
-        patch_id = patch_id.split(":")[0]
-        if len(patch_id) == 88:  # this is to avoid repository id to be treated as a patch
-            desc = await run(f"cd {pijul}; pijul patch --description {patch_id}")
-            if desc.strip() == f"Imported from Git commit {commit}":
-                # Okay, the patch is on another branch. So we apply it
-                print(f"  Syncing commit {commit}: {message}...")
-                await run(f"cd {pijul}; pijul apply {patch_id} --branch {branch}")
-                print(chalk.green(f"  Done. Reapplied patch {patch_id}"))
-                return
+    patch_id = mapping.findPatch(db, commit)
+    if patch_id is not None:
+        # Okay, the patch is on another branch. So we apply it
+        print(f"  Syncing commit {commit}...")
+        mapping.begin(db, "record", branch, commit, patch_id)
+        copyPatch(pijul, work, patch_id)
+        if await run(["pijul", "apply", patch_id, "--branch", branch], cwd=work, check=True) is None:
+            print(chalk.red(f"  Failed to reapply patch {patch_id}"))
+            mapping.end(db, "record", branch)
+            return False
+        await run(["pijul", "revert", "--all", "--branch", branch], cwd=work)
+        if not await publishPatch(pijul, work, lock, branch, patch_id):
+            print(chalk.red(f"  Failed to reapply patch {patch_id}"))
+            mapping.end(db, "record", branch)
+            return False
+        mapping.add(db, commit, branch, patch_id, "git")
+        mapping.end(db, "record", branch)
+        print(chalk.green(f"  Done. Reapplied patch {patch_id}"))
+        return True
 
     # Sync the commit itself now
-    author = (await run(f"cd {git}; git --no-pager show -s --format='%an <%ae>' {commit}")).strip()
-    date = (await run(f"cd {git}; git log -1 -s --format=%ci {commit}")).strip()
-    date = "T".join(date.split(" ", 1))
+    author = info["author"]
+    date = "T".join(info["date"].split(" ", 1))
     desc = f"Imported from Git commit {commit}"
-    message = (await run(f"cd {git}; git log -1 --format=%B {commit}")).split("\n")[0]
+    message = info["message"].split("\n")[0]
 
     print(f"  Syncing commit {commit}: {message}...")
 
-    await run(f"cd {pijul}; pijul checkout {branch}")
+    await run(["pijul", "checkout", branch], cwd=work)
+    # From now on, the copy may be left half-changed
+    mapping.begin(db, "record", branch, commit)
 
-    # For each changed file
-    for file in (await run(f"cd {git}; git diff-tree --no-commit-id --name-only -r {commit}")).split("\n"):
-        if file == "":
-            continue
-
-        await run(f"cd {git}; git checkout {commit}")
-        try:
-            with open(f"{git}/{file}") as f:
-                theirs = f.readlines()
-        except IOError:
-            theirs = None
-        await run(f"cd {git}; git checkout {commit}^")
+    # Decide what to do with each changed file by comparing blob IDs: those
+    # of the Git versions come with the diff, the one of the Pijul version is
+    # cached by stat. File bodies are only read when they're going to be
+    # merged, and copied from Git in chunks otherwise; real 3-way merges run
+    # on the process pool afterwards. Binary and huge files are never merged
+    # line by line: if both sides changed them, the Pijul version is kept.
+    size_limit = config.get("merge_size_limit", MERGE_SIZE_LIMIT)
+    results = []
+    merges = []
+    for changed in info["files"]:
+        file = changed["path"]
+        base_blob = changed["base_blob"]
+        their_blob = changed["blob"]
         try:
-            with open(f"{git}/{file}") as f:
-                base = f.readlines()
-        except IOError:
-            base = None
-        try:
-            with open(f"{pijul}/{file}") as f:
-                ours = f.readlines()
-        except IOError:
-            ours = None
+            our_blob = exporter.readEntry(work, file)[1]
+        except OSError:
+            our_blob = None
 
         # Perform a 3-way merge
-        if base is None and ours is None:
+        if base_blob == objects.NULL_BLOB and our_blob is None:
             # Assume file creation
-            base = []
-            ours = []
-        elif base is None and ours is not None:
+            results.append((file, "copy", their_blob, None))
+            continue
+        elif base_blob == objects.NULL_BLOB and our_blob is not None:
             # Assume file recreation
-            if ours == theirs:
+            if our_blob == their_blob:
                 # No changes
                 continue
-            else:
-                # Conflict
-                with open(f"{pijul}/{file}", "w") as f:
-                    f.write("/*\n")
-                    f.write(" * Notice by GitPijul proxy: this file was recreated on Git side (commit\n")
-                    f.write(f" * {commit[:10]}...). The original (Pijul) version is shown below; make sure to fix\n")
-                    f.write(" * the conflict yourself by merging the Git changes and remove this banner.\n")
-                    f.write(" */\n")
-                    f.write("".join(ours))
-                    print(chalk.yellow(f"  Conflict: {file} recreated by Git with different contents"))
+            ours = readWorkingFile(work, file, size_limit)
+            if ours is None or isBinary(ours):
+                results.append((file, "keep", None, f"  Conflict: {file} recreated by Git with different contents, keeping the Pijul version"))
                 continue
-        elif base is not None and theirs is None:
-            # Assume file deletion
-            os.unlink(f"{pijul}/{file}")
+            # Conflict
+            contents = b""
+            contents += b"/*\n"
+            contents += b" * Notice by GitPijul proxy: this file was recreated on Git side (commit\n"
+            contents += f" * {commit[:10]}...). The original (Pijul) version is shown below; make sure to fix\n".encode()
+            contents += b" * the conflict yourself by merging the Git changes and remove this banner.\n"
+            contents += b" */\n"
+            contents += ours
+            results.append((file, "write", contents, f"  Conflict: {file} recreated by Git with different contents"))
             continue
-        elif base is not None and ours is None:
+        elif our_blob is None:
             # Deleted by us
             continue
-        elif base == ours:
-            with open(f"{pijul}/{file}", "w") as f:
-                f.write("".join(theirs))
+        elif their_blob == objects.NULL_BLOB:
+            # Assume file deletion
+            results.append((file, "delete", None, None))
+            continue
+        elif base_blob == our_blob:
+            results.append((file, "copy", their_blob, None))
             continue
-        elif base == theirs:
-            with open(f"{pijul}/{file}", "w") as f:
-                f.write("".join(ours))
+        elif base_blob == their_blob or our_blob == their_blob:
+            # Nothing to take from Git side
             continue
 
-        # Assume file modifications on Git side or both sides
-        merge = merge3.Merge3(base, ours, theirs, is_cherrypick=True)
-        for t in merge.merge_regions():
-            if t[0] == "conflict":
-                # Aw!..
-                header = ""
-                header += "/*\n"
-                header += " * Notice by GitPijul proxy: this file was modified by both Git and Pijul. Make\n"
-                header += " * sure to merge the conflict yourself and remove this banner.\n"
-                header += " */\n"
-                print(chalk.yellow(f"  Conflict: {file} modified by both Git and Pijul"))
-                break
-        else:
-            # Yay! No conflicts
-            header = ""
+        # Assume file modifications on both sides
+        binary_conflict = (file, "keep", None, f"  Conflict: {file} is binary or too large to merge and was modified by both Git and Pijul, keeping the Pijul version")
+        if any(
+            size is None or size > size_limit
+            for size in [await objects.size(cat, base_blob), await objects.size(cat, their_blob)]
+        ):
+            results.append(binary_conflict)
+            continue
+        ours = readWorkingFile(work, file, size_limit)
+        if ours is None:
+            results.append(binary_conflict)
+            continue
+        base = await objects.read(cat, base_blob)
+        theirs = await objects.read(cat, their_blob)
+        if any(isBinary(data) for data in (base, ours, theirs)):
+            results.append(binary_conflict)
+            continue
+        try:
+            base, ours, theirs = toLines(base), toLines(ours), toLines(theirs)
+        except UnicodeDecodeError:
+            results.append(binary_conflict)
+            continue
+        merges.append((len(results), file, base, ours, theirs))
+        results.append(None)
 
-        merged = merge.merge_lines(
-            name_a="Pijul",
-            name_b=f"Git (commit {commit})",
-            start_marker=">" * 32,
-            mid_marker="=" * 32,
-            end_marker="<" * 32
-        )
-        os.makedirs(os.path.dirname(f"{pijul}/{file}"), exist_ok=True)
-        with open(f"{pijul}/{file}", "w") as f:
-            f.write(header)
-            f.write("".join(merged))
+    pool = getMergePool(config.get("merge_workers"))
+    if pool is None or len(merges) < 2:
+        merged = [mergeFile(commit, *merge[1:]) for merge in merges]
+    else:
+        loop = asyncio.get_running_loop()
+        merged = await asyncio.gather(*(
+            loop.run_in_executor(pool, mergeFile, commit, *merge[1:])
+            for merge in merges
+        ))
+    for merge, (contents, conflict) in zip(merges, merged):
+        results[merge[0]] = (merge[1], "write", contents, conflict)
+
+    # Write the results in the order of the diff
+    for file, action, data, conflict in results:
+        if conflict is not None:
+            print(chalk.yellow(conflict))
+        path = f"{work}/{file}"
+        if action == "delete":
+            os.unlink(path)
+        elif action == "write":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        elif action == "copy":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            await objects.copy(cat, data, path)
 
     # Check whether there are any changes
-    if await run(f"cd {pijul}; pijul status --short") == "":
+    if await run(["pijul", "status", "--short"], cwd=work) == "":
         print(chalk.yellow("  No changes (fast-forward)"))
-        handled_git_commits.append((commit, branch))
-        return
+        mapping.add(db, commit, branch, None, "git")
+        mapping.end(db, "record", branch)
+        return True
 
     # Record changes
-    author = shlex.quote(author)
-    message = shlex.quote(message)
-    r = await run(f"cd {pijul}; pijul record --add-new-files --all --author {author} --branch {branch} --date '{date}' --description '{desc}' --message {message}")
+    r = await run(["pijul", "record", "--add-new-files", "--all", "--author", author, "--branch", branch, "--date", date, "--description", desc, "--message", message], cwd=work, check=True)
+    if r is None:
+        print(chalk.red(f"  Failed to record commit {commit}"))
+        # Don't let the changes leak into the next commit
+        await run(["pijul", "revert", "--all", "--branch", branch], cwd=work)
+        mapping.end(db, "record", branch)
+        return False
     patch = r.replace("Recorded patch ", "").strip()
+    mapping.begin(db, "record", branch, commit, patch)
+    if not await publishPatch(pijul, work, lock, branch, patch):
+        # The copy is made anew next time, as it has a patch the branch hasn't
+        print(chalk.red(f"  Failed to apply patch {patch} to the repository"))
+        mapping.end(db, "record", branch)
+        return False
+    mapping.add(db, commit, branch, patch, "git")
+    mapping.end(db, "record", branch)
 
     print(chalk.green(f"  Done. Recorded patch {patch}"))
+    return True
 
 
-async def syncPijulToGit(git, pijul):
+async def listExportedPatches(git, rev):
+    # Returns (commit, patch) pairs for commits imported from Pijul, unless the
+    # patch was reverted later
+    log = stream(
+        ["git", "log", rev, "--grep=Imported from Pijul patch", "--grep=Reverted Pijul patch", "--format=[Commit Boundary]%H %B"],
+        cwd=git,
+        sep="[Commit Boundary]"
+    )
+    exported = []
+    reverted = set()
+    async for part in log:
+        if part != "":
+            commit, message = part.strip().split(" ", 1)
+            for row in message.split("\n"):
+                if row.startswith("Reverted Pijul patch "):
+                    reverted.add(row.split()[-1])
+                    break
+                if row.startswith("Imported from Pijul patch "):
+                    if row.split()[-1] not in reverted:
+                        exported.append((commit, row.split()[-1]))
+                    break
+    return exported
+
+def parsePijulTimestamp(timestamp):
+    timestamp = timestamp.strip()
+    if "." in timestamp:
+        timestamp = (
+            timestamp.split(".")[0] +  # 2019-05-26 14:52:37
+            "." +  # .
+            timestamp.split(".")[1][:6] +  # 697693
+            " " +  # space
+            timestamp.split(".")[1].split(" ", 1)[1]  # UTC
+        )
+    return timestamp
+
+async def readPijulLog(pijul, branch):
+    # Yields patches of the branch from the newest one as the log is read.
+    # Close the generator to stop early.
+    log = stream(["pijul", "log", "--branch", branch], cwd=pijul)
+    patch = None
+    try:
+        async for line in log:
+            if line.startswith("\x1B[1mHash"):
+                if patch is not None:
+                    yield patch
+                patch = {
+                    "patch_id": line.split(" ")[1].strip(),
+                    "author": None,
+                    "timestamp": None,
+                    "message": ""
+                }
+                header = 0
+                continue
+            if patch is None:
+                continue
+            header += 1
+            if header == 1:
+                # Internal id
+                pass
+            elif header == 2:
+                # Authors
+                patch["author"] = line.split(" ", 1)[1].strip()
+            elif header == 3:
+                # Timestamp
+                patch["timestamp"] = parsePijulTimestamp(line.split(" ", 1)[1])
+            elif header == 4:
+                # Empty line
+                pass
+            else:
+                # Message and description
+                patch["message"] += line[4:] + "\n"
+        if patch is not None:
+            yield patch
+    finally:
+        await log.aclose()
+
+
+async def syncPijulToGit(db, git, pijul, config):
     print("  Syncing Pijul -> Git...")
-    for r in (await run(f"cd {pijul}; pijul branches")).split("\n"):
-        if r == "":
-            continue
+    branches = [r[2:] for r in (await run(["pijul", "branches"], cwd=pijul)).split("\n") if r != ""]
+    limit = asyncio.Semaphore(config.get("branch_workers", BRANCH_WORKERS))
 
-        branch = r[2:]
-        await run(f"cd {git}; git checkout {branch}")
+    # Every branch is built in its own export copy, so branches are exported
+    # at the same time; only the commits are written to Git one at a time
+    async def syncBranch(branch):
+        async with limit:
+            await syncPijulToGitBranch(db, export, branch, git, pijul, cutoff, config.get("since"))
 
+    cutoff = await readCutoff(git, config.get("since"))
+    export = await startExport(git)
+    try:
+        await gatherAll(syncBranch(branch) for branch in branches)
+    finally:
+        pushed = await finishExport(db, export, pijul)
+    if pushed is None:
+        return
+    await pushGit(db, git, pushed)
+    for branch in branches:
+        await updateWatermark(db, branch, git, pijul)
 
-        # List patches that were exported to Git already
-        r = await run(f"cd {git}; git log --grep='Imported from Pijul patch' --format='[Commit Boundary]%H %B'")
-        exported = {}
-        for part in r.split("[Commit Boundary]"):
-            if part != "":
-                commit, message = part.strip().split(" ", 1)
-                for row in message.split("\n"):
-                    if row.startswith("Imported from Pijul patch "):
-                        patch_id = row.split()[-1]
-                        break
-                else:
-                    continue
-                if (commit, branch) not in handled_git_commits:
-                    exported[patch_id] = commit
-
-        # List Pijul patches
-        r = (await run(f"cd {pijul}; pijul log --branch {branch}")).split("\n")
-
-        i = 0
-        pijul_patches = {}
-        while i < len(r):
-            if r[i] == "":
-                i += 1
-                continue
+def isOlder(patch, cutoff):
+    # Patches from before mirroring started are in Git already
+    if cutoff is None:
+        return False
+    try:
+        return parseDate(patch["timestamp"]) < cutoff
+    except ValueError:
+        return False
 
-            # Hash
-            patch_id = r[i].split(" ")[1].strip()
-            i += 1
-            # Internal id
-            i += 1
-            # Authors
-            authors = r[i].split(" ", 1)[1].strip()
-            i += 1
-            # Timestamp
-            timestamp = r[i].split(" ", 1)[1].strip()
-            if "." in timestamp:
-                timestamp = (
-                    timestamp.split(".")[0] +  # 2019-05-26 14:52:37
-                    "." +  # .
-                    timestamp.split(".")[1][:6] +  # 697693
-                    " " +  # space
-                    timestamp.split(".")[1].split(" ", 1)[1]  # UTC
-                )
-            i += 1
-            # Empty line
-            i += 1
-            # Message and description
-            message = ""
-            while i < len(r) and not r[i].startswith("\x1B[1mHash"):
-                message += r[i][4:] + "\n"
-                i += 1
-
-            # Check whether this patch was actually imported from Git
-            if any((line.startswith("Imported from Git commit ") for line in message.split("\n"))):
-                continue
+async def hasUnimportedCommits(db, git, branch, since=None):
+    # Patches must not be exported on top of Git commits that aren't imported
+    # yet: the import stops at exported commits, so those would never be
+    # imported
+    tip = await run(["git", "rev-parse", "--verify", "-q", f"refs/heads/{branch}^{{commit}}"], cwd=git, check=True)
+    if tip is None or mapping.lookup(db, tip.strip(), branch) is not None:
+        return False
+    git_commits = await readGitCommits(db, git, [(tip.strip(), branch)], since=since)
+    return planGitToPijul(db, git_commits, [(tip.strip(), branch)]) != []
 
-            pijul_patches[patch_id] = {
-                "author": authors,
-                "timestamp": timestamp,
-                "message": message.strip()
-            }
+async def syncPijulToGitBranch(db, export, branch, git, pijul, cutoff=None, since=None):
+    if await hasUnimportedCommits(db, git, branch, since):
+        print(chalk.yellow(f"  Branch {branch} has Git commits that aren't imported yet, not exporting it"))
+        return
+    # Look only at what changed since the last export, unless the Git
+    # branch was rewritten or the Pijul patch we stopped at was unrecorded
+    watermark = mapping.getWatermark(db, branch)
+    until = None
+    if watermark is not None:
+        if await run(["git", "merge-base", "--is-ancestor", watermark[1], f"refs/heads/{branch}"], cwd=git, check=True) is not None:
+            until = watermark[0]
+    # The log is only read up to the watermark. If it's not there, the whole
+    # log is read anyway, so that's what the rescan uses.
+    incremental = False
+    patches = []
+    log = readPijulLog(pijul, branch)
+    try:
+        async for patch in log:
+            if patch["patch_id"] == until:
+                incremental = True
+                break
+            patches.append(patch)
+    finally:
+        await log.aclose()
+    if not incremental:
+        print("  Rescanning the whole history...")
 
+    # List patches that were exported to Git already
+    if incremental:
+        exported = mapping.listExported(db, branch)
+        since = f"{watermark[1]}..refs/heads/{branch}"
+    else:
+        exported = {}
+        since = f"refs/heads/{branch}"
+    # Only missing rows are added, oldest first, so that the frontier of the
+    # branch doesn't move back
+    for commit, patch_id in (await listExportedPatches(git, since))[::-1]:
+        entry = mapping.lookup(db, commit, branch)
+        if entry is None or entry[1] != "git":
+            exported[patch_id] = commit
+        if entry is None:
+            mapping.add(db, commit, branch, patch_id, "pijul")
 
-        # Generate pijul_patches->exported diff
-        actions = []
-        for patch_id, data in pijul_patches.items():
-            if patch_id not in exported:
-                # New patch
-                actions.append({
-                    "action": "add",
-                    "patch_id": patch_id,
-                    **data
-                })
+    # Generate the export plan, oldest first. Patches that are in Git already
+    # (imported from Git or exported before) only have to be applied to the
+    # export copy.
+    actions = []
+    if not incremental:
+        # Only a full rescan can tell that a patch is gone
+        present = {patch["patch_id"] for patch in patches}
         for patch_id, commit in exported.items():
-            if patch_id not in pijul_patches:
+            if patch_id not in present:
                 # Revert patch
                 actions.append({
                     "action": "remove",
                     "patch_id": patch_id,
-                    **data
+                    **await readExportedCommit(git, commit)
                 })
+    for patch in patches[::-1]:
+        # Check whether this patch was actually imported from Git
+        imported = any((line.startswith("Imported from Git commit ") for line in patch["message"].split("\n")))
+        actions.append({
+            "action": "apply" if imported or patch["patch_id"] in exported or isOlder(patch, cutoff) else "add",
+            "patch_id": patch["patch_id"],
+            "author": patch["author"],
+            "timestamp": patch["timestamp"],
+            "message": patch["message"].strip()
+        })
+
+    pending = [action["patch_id"] for action in actions if action["action"] == "add"]
+    scratch = await openScratch(git, pijul, branch, pending)
+    await exportPijulPatches(export, branch, pijul, scratch, actions)
+
+async def readExportedCommit(git, commit):
+    # Returns author, timestamp and message of the patch a commit was exported
+    # from
+    r = await run(["git", "log", "-1", "--format=%an <%ae>%x00%aI%x00%B", commit], cwd=git)
+    author, timestamp, message = r.split("\0", 2)
+    message = "\n".join(line for line in message.split("\n") if not line.startswith("Imported from Pijul patch "))
+    return {
+        "author": author,
+        "timestamp": timestamp,
+        "message": message.strip()
+    }
 
-        # Sort actions somehow
-        actions.sort(key=lambda action: action["timestamp"])
+async def updateWatermark(db, branch, git, pijul):
+    log = stream(["pijul", "log", "--hash-only", "--branch", branch], cwd=pijul)
+    try:
+        async for patch_id in log:
+            patch_id = patch_id.split(":")[0]
+            if len(patch_id) == 88:  # this is to avoid repository id to be treated as a patch
+                # The log starts with the newest patch
+                break
+        else:
+            return
+    finally:
+        await log.aclose()
+    commit = (await run(["git", "rev-parse", f"refs/heads/{branch}"], cwd=git, check=True) or "").strip()
+    if commit == "":
+        return
+    mapping.setWatermark(db, branch, patch_id, commit)
+
+async def startExport(git):
+    return await exporter.start(git)
 
-        print("  Temporary reverting all changes...")
-        for action in actions[::-1]:
-            patch_id = action["patch_id"]
-            if action["action"] == "add":
-                await run(f"cd {pijul}; pijul unrecord {patch_id} --branch {branch}")
-            elif action["action"] == "remove":
-                await run(f"cd {pijul}; pijul apply {patch_id} --branch {branch}; pijul revert --all --branch {branch}")
+async def finishExport(db, export, pijul):
+    # Returns the branches that got new commits, or None on failure.
+    # fast-import updates the branches when it finishes.
+    branches = sorted({branch for mark, branch, patch_id, action in export["commits"]})
+    for branch in branches:
+        mapping.begin(db, "commit", branch)
+    marks = await exporter.finish(export)
+    if marks is None:
+        print(chalk.red("  Failed to import commits to Git"))
+        for branch in branches:
+            # The export copies have patches that never got to Git
+            shutil.rmtree(scratchPath(export["git"], pijul, branch), ignore_errors=True)
+            mapping.end(db, "commit", branch)
+        return None
+    for mark, branch, patch_id, action in export["commits"]:
+        if action == "add":
+            mapping.add(db, marks[mark], branch, patch_id, "pijul")
+        elif action == "remove":
+            mapping.forgetPatch(db, patch_id, branch)
+    for branch in branches:
+        mapping.begin(db, "push", branch)
+        mapping.end(db, "commit", branch)
+    return branches
 
-        for action in actions:
-            await syncPijulToGitPatch(branch, git, pijul, **action)
+async def pushGit(db, git, branches):
+    if branches != []:
+        print("  Pushing...")
+        if await run(["git", "push", "origin"] + [f"refs/heads/{branch}" for branch in branches], cwd=git, check=True) is None:
+            print(chalk.red("  Failed to push to Git"))
+            return
+        for branch in branches:
+            mapping.end(db, "push", branch)
 
-        if actions != []:
-            print("  Pushing...")
-            await run(f"cd {git}; git push")
+def scratchPath(git, pijul, branch):
+    # The copy depends on what's in Git, and several Git repos may mirror the
+    # same Pijul repo
+    return f"{pijul}-export-" + hashlib.sha256(f"{git} {branch}".encode()).hexdigest()[:16]
 
-async def syncPijulToGitPatch(branch, git, pijul, action, patch_id, author, timestamp, message):
+async def openScratch(git, pijul, branch, pending):
+    # The export copy of a branch holds exactly the patches that are in Git
+    # already. Intermediate states are built there, so the live branch never
+    # has to be unrecorded and reapplied. When the copy is created, the
+    # pending patches are unrecorded from it once.
+    scratch = scratchPath(git, pijul, branch)
+    if not os.path.isdir(scratch):
+        print("  Creating export copy of the branch...")
+        shutil.rmtree(f"{scratch}.tmp", ignore_errors=True)
+        await run(["cp", "-a", pijul, f"{scratch}.tmp"])
+        await run(["pijul", "checkout", branch], cwd=f"{scratch}.tmp")
+        for patch_id in pending[::-1]:
+            await run(["pijul", "unrecord", patch_id, "--branch", branch], cwd=f"{scratch}.tmp")
+        await run(["pijul", "revert", "--all", "--branch", branch], cwd=f"{scratch}.tmp")
+        os.rename(f"{scratch}.tmp", scratch)
+    return scratch
+
+async def listPijulPatches(pijul, branch):
+    # Returns patches of the branch, newest first
+    patches = []
+    async for patch_id in stream(["pijul", "log", "--hash-only", "--branch", branch], cwd=pijul):
+        patch_id = patch_id.split(":")[0]
+        if len(patch_id) == 88:  # this is to avoid repository id to be treated as a patch
+            patches.append(patch_id)
+    return patches
+
+def copyPatch(pijul, scratch, patch_id):
+    # Make the patch known to the export copy so that it can be applied there
+    for path in glob.glob(f"{pijul}/.pijul/patches/{patch_id}.*"):
+        target = f"{scratch}/.pijul/patches/{os.path.basename(path)}"
+        if not os.path.exists(target):
+            shutil.copy(path, target)
+
+async def exportPijulPatches(export, branch, pijul, scratch, actions):
+    in_scratch = set(await listPijulPatches(scratch, branch))
+    for action in actions:
+        await syncPijulToGitPatch(export, branch, pijul, scratch, in_scratch, **action)
+
+async def readPijulStatus(pijul):
+    # The files a patch touched differ between the pristine and the working
+    # copy until it's reverted. Returns None if pijul can't tell, so that the
+    # whole tree is scanned.
+    status = await run(["pijul", "status", "--short"], cwd=pijul, check=True)
+    if status is None:
+        return None
+    # Lines are "<status> <path>"
+    return [line[2:].strip() for line in status.split("\n") if line.strip() != ""]
+
+async def syncPijulToGitPatch(export, branch, pijul, scratch, in_scratch, action, patch_id, author, timestamp, message):
     small_patch_id = patch_id[:10] + "..."
+    if action == "apply":
+        # Git has it already, only the export copy has to catch up
+        if patch_id not in in_scratch:
+            copyPatch(pijul, scratch, patch_id)
+            await run(["pijul", "apply", patch_id, "--branch", branch], cwd=scratch)
+            await run(["pijul", "revert", "--all", "--branch", branch], cwd=scratch)
+            in_scratch.add(patch_id)
+        return
+
+    # If the export copy is in the right state already (e.g. a previous export
+    # was interrupted), the whole tree is compared with Git instead
+    paths = None
     if action == "add":
         print(f"  Syncing new patch {small_patch_id}: {message}")
-        await run(f"cd {pijul}; pijul apply {patch_id} --branch {branch}")
+        if patch_id not in in_scratch:
+            copyPatch(pijul, scratch, patch_id)
+            await run(["pijul", "apply", patch_id, "--branch", branch], cwd=scratch)
+            paths = await readPijulStatus(scratch)
+            in_scratch.add(patch_id)
     elif action == "remove":
         print(f"  Reverting patch {small_patch_id}: {message}")
-        await run(f"cd {pijul}; pijul unrecord {patch_id} --branch {branch}")
-
-    await run(f"cd {pijul}; pijul revert --all --branch {branch}")
-
-    # Synchronize
-    await run(f"rsync -rv -f'- .git/' -f'- .pijul/' {pijul}/ {git}/")
+        if patch_id in in_scratch:
+            await run(["pijul", "unrecord", patch_id, "--branch", branch], cwd=scratch)
+            paths = await readPijulStatus(scratch)
+            in_scratch.discard(patch_id)
+    await run(["pijul", "revert", "--all", "--branch", branch], cwd=scratch)
 
     # Commit
-    is_empty = (await run(f"cd {git}; git status --short")).strip() == ""
-
     if action == "add":
-        message = shlex.quote(f"{message}\n\nImported from Pijul patch {patch_id}")
+        message = f"{message}\n\nImported from Pijul patch {patch_id}"
     elif action == "remove":
-        message = shlex.quote(f"{message}\n\nReverted Pijul patch {patch_id}")
-    author = shlex.quote(author)
-    date = str(timestamp)
-    await run(f"cd {git}; git add --all; git commit --author={author} --date='{date}' --message={message} --no-edit --allow-empty")
-    commit = (await run(f"cd {git}; git rev-parse HEAD")).strip()
-
-    if is_empty:
-        print(chalk.yellow(f"  No changes (fast-forward), committed {commit}"))
+        message = f"{message}\n\nReverted Pijul patch {patch_id}"
+    mark, changed = await exporter.commit(export, branch, scratch, author, str(timestamp), message, paths)
+    export["commits"].append((mark, branch, patch_id, action))
+
+    if changed == 0:
+        print(chalk.yellow("  No changes (fast-forward)"))
     else:
-        print(chalk.green(f"  Done. Committed {commit}"))
+        print(chalk.green(f"  Done. Changed {changed} files"))
+
+
+async def openIndex(config, rebuild=True):
+    # Returns None if the index is missing and rebuild is False
+    git_path = urlToPath(config["git"]["url"])
+    pijul_path = urlToPath(config["pijul"]["url"])
+
+    index_path = indexPath(config["git"]["url"], config["pijul"]["url"])
+    if not os.path.isfile(index_path):
+        if not rebuild:
+            return None
+        # Build the index aside so that an interrupted rebuild is not mistaken
+        # for a complete one
+        if os.path.isfile(index_path + ".tmp"):
+            os.unlink(index_path + ".tmp")
+        db = mapping.open(index_path + ".tmp")
+        try:
+            await rebuildIndex(db, git_path, pijul_path)
+        finally:
+            db.close()
+        os.replace(index_path + ".tmp", index_path)
+
+    return mapping.open(index_path)
+
+
+async def resume(db, git, pijul):
+    # Finish or roll back the steps an interrupted sync left in the journal
+    journal = mapping.listJournal(db)
+    if journal == [] or not os.path.isdir(git) or not os.path.isdir(pijul):
+        return
+    print("  Resuming interrupted sync...")
+    git_branches = []
+    for step, branch, commit, patch in journal:
+        if step == "record":
+            await resumeRecord(db, pijul, branch, commit, patch)
+        elif step == "commit":
+            # fast-import may have updated the branch, and the index is
+            # recovered from Git on the next export, so push it just in case.
+            # The export copy may have patches that never got to Git, so
+            # it's made anew.
+            shutil.rmtree(scratchPath(git, pijul, branch), ignore_errors=True)
+            mapping.begin(db, "push", branch)
+            mapping.end(db, "commit", branch)
+            git_branches.append(branch)
+        elif step == "push":
+            git_branches.append(branch)
+    await pushGit(db, git, sorted(set(git_branches)))
+    if any(step == "pijul-push" for step, branch, commit, patch in journal):
+        await pushPijul(db, pijul)
+    print(chalk.green("  Done."))
+
+async def resumeRecord(db, pijul, branch, commit, patch):
+    work = importPath(pijul, branch)
+    if patch is not None and patch in await listPijulPatches(pijul, branch):
+        # Only the index wasn't updated
+        mapping.add(db, commit, branch, patch, "git")
+    elif patch is not None and os.path.isdir(work) and await publishPatch(pijul, work, asyncio.Lock(), branch, patch):
+        print(chalk.green(f"  Published patch {patch} of commit {commit}"))
+        mapping.add(db, commit, branch, patch, "git")
+    elif os.path.isdir(work):
+        # The commit is imported anew. The copy is made anew too if it has a
+        # patch the branch hasn't; otherwise it only has to be cleaned up.
+        print(chalk.yellow(f"  Rolling back import of commit {commit}"))
+        await run(["pijul", "revert", "--all", "--branch", branch], cwd=work)
+    mapping.end(db, "record", branch)
+
+
+async def pullGitBranch(url, branch, since=None):
+    # Fetch a single branch and fast-forward it. Returns False on failure,
+    # e.g. if the branch doesn't exist or diverged from origin: resetting it
+    # is left to a full sync.
+    path = urlToPath(url)
+    print(f"  Git: Fetching branch {branch}...")
+    if await run(["git", "check-ref-format", "--branch", branch], cwd=path, check=True) is None:
+        return False
+    if object_pool is not None and since is None:
+        await fillObjectPool(url, branch)
+    if await run(["git", "fetch", "origin", *fetchOptions(path, since), f"+refs/heads/{branch}:refs/remotes/origin/{branch}"], cwd=path, check=True) is None:
+        return False
+    if await updateBranches(path, [branch], force=False) != {}:
+        return False
+    print(chalk.green("  Done."))
+    return True
+
+
+async def importGitBranch(config, db, branch, tip):
+    # Import everything up to tip that's new on a single branch. The commits
+    # are read from the frontier of the branch rather than from where a
+    # webhook says the branch was, as earlier webhooks may have been lost.
+    git_path = urlToPath(config["git"]["url"])
+    pijul_path = urlToPath(config["pijul"]["url"])
+    print("  Collecting new Git commits...")
+    git_commits = await readGitCommits(db, git_path, [(tip, branch)], since=config.get("since"))
+    presync = planGitToPijul(db, git_commits, [(tip, branch)])
+    await syncGitToPijul(db, git_path, pijul_path, presync, git_commits, config)
 
 
+async def syncGitBranch(config, db, branch, before, after):
+    # Import the changes of a single branch up to after. Returns False if
+    # that's not possible and a full sync is required.
+    git_path = urlToPath(config["git"]["url"])
+
+    if not await pullGitBranch(config["git"]["url"], branch, config.get("since")):
+        return False
+    if await run(["git", "merge-base", "--is-ancestor", before, after], cwd=git_path, check=True) is None:
+        # Force-push, or we don't know the old commit
+        return False
 
-async def sync(config):
-    await pullGit(config["git"]["url"])
     await pullPijul(config["pijul"]["url"])
-    presync = await presyncGitToPijul(urlToPath(config["git"]["url"]), urlToPath(config["pijul"]["url"]))
-    await syncPijulToGit(urlToPath(config["git"]["url"]), urlToPath(config["pijul"]["url"]))
-    await syncGitToPijul(urlToPath(config["git"]["url"]), urlToPath(config["pijul"]["url"]), presync)
-    print(chalk.green(chalk.bold("  Sync complete!")))
\ No newline at end of file
+    await importGitBranch(config, db, branch, after)
+    return True
+
+
+async def syncPijulPatches(config, db, branch, patches):
+    # Export the given patches of a single branch. Returns False if that's not
+    # possible and a full sync is required.
+    git_path = urlToPath(config["git"]["url"])
+    pijul_path = urlToPath(config["pijul"]["url"])
+
+    if mapping.getWatermark(db, branch) is None or not os.path.isdir(scratchPath(git_path, pijul_path, branch)):
+        # Never exported this branch before
+        return False
+    if not await pullGitBranch(config["git"]["url"], branch, config.get("since")):
+        return False
+    await pullPijul(config["pijul"]["url"])
+    if await hasUnimportedCommits(db, git_path, branch, config.get("since")):
+        # The fetch brought new Git commits, which have to be imported first
+        tip = (await run(["git", "rev-parse", f"refs/heads/{branch}"], cwd=git_path)).strip()
+        await importGitBranch(config, db, branch, tip)
+        if await hasUnimportedCommits(db, git_path, branch, config.get("since")):
+            return False
+    for patch_id in patches:
+        if await run(["pijul", "patch", "--description", patch_id], cwd=pijul_path, check=True) is None:
+            # We don't have the patch, so the event is probably stale
+            return False
+
+    # The new patches are exactly the ones after the watermark, so export the
+    # branch as usual
+    print("  Syncing Pijul -> Git...")
+    cutoff = await readCutoff(git_path, config.get("since"))
+    export = await startExport(git_path)
+    try:
+        await syncPijulToGitBranch(db, export, branch, git_path, pijul_path, cutoff, config.get("since"))
+    finally:
+        pushed = await finishExport(db, export, pijul_path)
+    if pushed is not None:
+        await pushGit(db, git_path, pushed)
+        await updateWatermark(db, branch, git_path, pijul_path)
+    return True
+
+
+async def syncTargets(config, targets):
+    # Returns False if the targets can't be synced separately
+    if not os.path.isdir(urlToPath(config["git"]["url"])) or not os.path.isdir(urlToPath(config["pijul"]["url"])):
+        return False
+    db = await openIndex(config, rebuild=False)
+    if db is None:
+        return False
+    try:
+        await resume(db, urlToPath(config["git"]["url"]), urlToPath(config["pijul"]["url"]))
+        for target in targets:
+            if target["kind"] == "git":
+                if not await syncGitBranch(config, db, target["branch"], target["before"], target["after"]):
+                    return False
+            elif target["kind"] == "pijul":
+                if not await syncPijulPatches(config, db, target["branch"], target["patches"]):
+                    return False
+    finally:
+        db.close()
+    return True
+
+
+async def timed(timings, stage, coro):
+    # Await coro, recording when the stage started and finished
+    start = time.monotonic()
+    try:
+        return await coro
+    finally:
+        timings.append((stage, start, time.monotonic()))
+
+def printTimings(timings, start):
+    # Stages are listed relative to the start of the sync, so that the ones
+    # running concurrently are easy to spot
+    for stage, begin, end in sorted(timings, key=lambda timing: timing[1]):
+        print(f"  {stage}: {begin - start:.2f}s -> {end - start:.2f}s ({end - begin:.2f}s)")
+
+
+async def sync(config, targets=None):
+    # targets is a list of changes known from webhooks, or None if everything
+    # has to be synced
+    if targets is not None:
+        if await syncTargets(config, targets):
+            print(chalk.green(chalk.bold("  Sync complete!")))
+            return
+        print(chalk.yellow("  Falling back to full sync"))
+
+    start = time.monotonic()
+    timings = []
+    git_path = urlToPath(config["git"]["url"])
+    pijul_path = urlToPath(config["pijul"]["url"])
+
+    # Collecting Git commits only needs the Git repo and the index, so it
+    # doesn't wait for Pijul fetch, unless the index has to be rebuilt
+    async def fetchGit(db):
+        reset = await timed(timings, "Git fetch", pullGit(config["git"]["url"], config.get("since")))
+        await forgetUnpushed(db, git_path, pijul_path, reset)
+        if db is not None:
+            return await timed(timings, "Git presync", presyncGitToPijul(db, git_path, pijul_path, config.get("since")))
+
+    db = await openIndex(config, rebuild=False)
+    try:
+        if db is not None:
+            await timed(timings, "Resume", resume(db, git_path, pijul_path))
+        # If one side fails, the other one is still waited for, so that
+        # nothing touches the working copies once the sync is over
+        collected, _ = await gatherAll([
+            fetchGit(db),
+            timed(timings, "Pijul fetch", pullPijul(config["pijul"]["url"]))
+        ])
+        if db is None:
+            db = await timed(timings, "Index rebuild", openIndex(config))
+            collected = await timed(timings, "Git presync", presyncGitToPijul(db, git_path, pijul_path, config.get("since")))
+        presync, git_commits = collected
+        # Git commits are imported first, as patches aren't exported on top of
+        # commits that aren't imported
+        await timed(timings, "Git -> Pijul", syncGitToPijul(db, git_path, pijul_path, presync, git_commits, config))
+        await timed(timings, "Pijul -> Git", syncPijulToGit(db, git_path, pijul_path, config))
+    finally:
+        if db is not None:
+            db.close()
+        printTimings(timings, start)
+    print(chalk.green(chalk.bold("  Sync complete!")))